@@ -0,0 +1,158 @@
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Export of positions into columnar files.
+
+Each column of positions is written into NumPy `.npy` file in output
+directory, i.e. `timestamp.npy`, `lon.npy` or `cum_distance.npy`. The
+files can be memory mapped with::
+
+    lon = np.load('output/lon.npy', mmap_mode='r')
+
+When positions of tracks are exported, then `track.npy` file contains
+index of track of each position and the tracks are stored in
+`tracks.json` file.
+"""
+
+import json
+import logging
+import os
+import struct
+
+import numpy as np
+import numpy.lib.format
+
+from antrak.dao import export as export_dao
+from antrak.db import tx
+
+logger = logging.getLogger(__name__)
+
+# size of header of `.npy` file; the header is rewritten with the number
+# of written items when a file is closed, so its size has to be fixed
+NPY_HEADER_SIZE = 128
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+
+class NpyWriter:
+    """
+    Writer of one dimensional array into `.npy` file in chunks.
+
+    :var path: Path of the file.
+    :var dtype: NumPy data type of the array.
+    :var count: Number of written items.
+    """
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+
+        self._file = open(path, 'wb')
+        self._file.write(npy_header(self.dtype, 0))
+
+    def write(self, data):
+        """
+        Append data to the file.
+
+        :param data: One dimensional array.
+        """
+        np.ascontiguousarray(data, dtype=self.dtype).tofile(self._file)
+        self.count += len(data)
+
+    def close(self):
+        """
+        Write number of written items into file header and close the file.
+        """
+        f = self._file
+        f.seek(0)
+        f.write(npy_header(self.dtype, self.count))
+        f.close()
+
+@tx
+async def export(
+        dev, output, start=None, end=None, query=None, mode='text'
+    ):
+    """
+    Export positions of a device into columnar files.
+
+    Positions in time period are exported. If query is specified, then
+    only positions of tracks matching the query are exported.
+
+    :param dev: Device from which positions where obtained.
+    :param output: Output directory.
+    :param start: Start of time period.
+    :param end: End of time period.
+    :param query: Trip and track name query.
+    :param mode: Search mode of the query, see `SEARCH_MODES`.
+    """
+    os.makedirs(output, exist_ok=True)
+
+    if query is not None:
+        tracks = await export_dao.find_tracks(
+            dev, query, start=start, end=end, mode=mode
+        )
+        with open(os.path.join(output, 'tracks.json'), 'w') as f:
+            json.dump([to_json(t) for t in tracks], f, indent=2)
+
+    dtype = export_dao.CopyDecoder(
+        export_dao.export_columns(query is not None)
+    ).result_dtype
+    writers = {
+        n: NpyWriter(os.path.join(output, n + '.npy'), dtype[n])
+        for n in dtype.names
+    }
+
+    def write(data):
+        for n, w in writers.items():
+            w.write(data[n])
+
+    try:
+        count = await export_dao.export_pos(
+            dev, write, start=start, end=end, query=query, mode=mode
+        )
+    finally:
+        for w in writers.values():
+            w.close()
+    logger.info('exported {} positions into {}'.format(count, output))
+
+def npy_header(dtype, count):
+    """
+    Create header of `.npy` file of one dimensional array.
+
+    :param dtype: NumPy data type of the array.
+    :param count: Length of the array.
+    """
+    header = {
+        'descr': numpy.lib.format.dtype_to_descr(dtype),
+        'fortran_order': False,
+        'shape': (count,),
+    }
+    size = NPY_HEADER_SIZE - len(NPY_MAGIC) - 2
+    header = repr(header).ljust(size - 1).encode('latin1') + b'\n'
+    assert len(header) == size
+    return NPY_MAGIC + struct.pack('<H', size) + header
+
+def to_json(track):
+    return {
+        'trip': track['trip'],
+        'name': track['name'],
+        'start': track['start'].isoformat(),
+        'end': track['end'].isoformat(),
+    }
+
+# vim: sw=4:et:ai
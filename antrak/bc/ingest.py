@@ -0,0 +1,311 @@
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Live ingest of positions from a stream of NMEA sentences.
+
+NMEA sentences are read from TCP socket, a device (i.e. pty or serial
+port) or standard input. Positions are filtered and saved in a database
+in micro-batches.
+
+The reader of NMEA sentences and the database writer are connected with
+bounded queue. If the writer cannot keep up, then the reader stops
+reading its source.
+"""
+
+import asyncio
+import asyncpg
+import logging
+import os
+import re
+import signal
+import stat
+import sys
+from collections import Counter
+
+from antrak import nmea
+from antrak.bc.track import filter_quality, log_rejected, save_batches, \
+    AltitudeSpeedFilter, MAX_DOP, MAX_ALT_SPEED, ALT_SPEED_PERIOD
+from antrak.position import PositionBatch
+from antrak.util import to_async
+
+logger = logging.getLogger(__name__)
+
+# default number of positions, which triggers write to a database
+FLUSH_SIZE = 500
+
+# default maximum time [s] positions wait before write to a database
+FLUSH_INTERVAL = 2
+
+# maximum number of batches of positions waiting for the database writer
+QUEUE_SIZE = 16
+
+# signals stopping ingest; positions waiting for the database writer are
+# saved before ingest stops
+SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+# TCP socket source; host does not contain `/`, so file paths are not
+# matched
+RE_TCP = re.compile(r'^(?P<host>[^/]*):(?P<port>\d+)$')
+
+# minimum and maximum delay [s] before reconnecting to a source
+RECONNECT_MIN = 1
+RECONNECT_MAX = 30
+
+async def ingest(
+        dev,
+        source,
+        flush_size=FLUSH_SIZE,
+        flush_interval=FLUSH_INTERVAL,
+        max_dop=MAX_DOP,
+        max_alt_speed=MAX_ALT_SPEED,
+        alt_speed_period=ALT_SPEED_PERIOD,
+    ):
+    """
+    Read positions from a source of NMEA sentences and save them in
+    a database.
+
+    The source is one of
+
+    `-`
+        Standard input. Ingest stops at the end of input.
+    `host:port`
+        TCP socket, see `RE_TCP`.
+    file path
+        Device, i.e. pty or serial port, or regular file. Ingest stops at
+        the end of regular file.
+
+    Connection to TCP socket or device is reestablished when lost or when
+    the device does not exist, i.e. it is unplugged.
+
+    Ingest stops on `SIGINT` or `SIGTERM` signal. Reading of the source is
+    stopped and pending positions are saved in a database. Next signal
+    stops saving of the positions. Ingest also stops, when positions
+    cannot be saved due to an error, which is not a connection error.
+
+    :param dev: Device from which positions where obtained.
+    :param source: Source of NMEA sentences.
+    :param flush_size: Number of positions, which triggers write to
+        a database.
+    :param flush_interval: Maximum time [s] positions wait before write
+        to a database.
+    :param max_dop: Maximum value of dilution of precision.
+    :param max_alt_speed: Maximum altitude speed [m/s].
+    :param alt_speed_period: Maximum time difference between positions
+        [s], for which altitude speed is checked.
+    """
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue(QUEUE_SIZE)
+    rejected = Counter()
+    check = AltitudeSpeedFilter(max_alt_speed, alt_speed_period, rejected)
+
+    async def read():
+        async for batch in read_pos(source):
+            batch = check(next(filter_quality([batch], max_dop, rejected)))
+            if len(batch):
+                await queue.put(batch)
+
+    def interrupt():
+        if reader.done():
+            logger.info('ingest interrupted, positions are not saved')
+            writer.cancel()
+        else:
+            logger.info('ingest interrupted, saving pending positions')
+            reader.cancel()
+
+    writer = asyncio.ensure_future(
+        write_pos(dev, queue, flush_size, flush_interval)
+    )
+    reader = asyncio.ensure_future(read())
+    for sig in SIGNALS:
+        loop.add_signal_handler(sig, interrupt)
+    try:
+        # writer stops only on error, then there is no point in reading
+        await asyncio.wait(
+            [reader, writer], return_when=asyncio.FIRST_COMPLETED
+        )
+        if not writer.done():
+            check.close()
+            stop = asyncio.ensure_future(queue.put(None))
+            await asyncio.wait(
+                [stop, writer], return_when=asyncio.FIRST_COMPLETED
+            )
+            await asyncio.wait([writer])
+            stop.cancel()
+    except asyncio.CancelledError:
+        writer.cancel()
+        raise
+    finally:
+        for sig in SIGNALS:
+            loop.remove_signal_handler(sig)
+        reader.cancel()
+        await asyncio.wait([reader, writer])
+        log_rejected(rejected)
+
+    for task in (writer, reader):
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+
+async def read_pos(source):
+    """
+    Read batches of positions from a source of NMEA sentences.
+
+    Reconnect to a source, which is not standard input or regular file,
+    when its connection is lost or it cannot be opened.
+
+    :param source: Source of NMEA sentences, see `ingest`.
+    """
+    delay = RECONNECT_MIN
+    while True:
+        try:
+            reader, close = await open_source(source)
+        except OSError as ex:
+            logger.warning('cannot open {}: {}; retry in {}s'.format(
+                source, ex, delay
+            ))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+            continue
+
+        logger.info('reading positions from {}'.format(source))
+        delay = RECONNECT_MIN
+        try:
+            async for batch in nmea.parse_stream(reader):
+                yield batch
+        except OSError as ex:
+            # i.e. connection reset or EIO error of closed pty
+            logger.warning('connection to {} lost: {}'.format(source, ex))
+        finally:
+            close()
+
+        if source == '-' or os.path.isfile(source):
+            break
+
+        logger.warning('{} closed; reconnect in {}s'.format(source, delay))
+        await asyncio.sleep(delay)
+
+async def open_source(source):
+    """
+    Open source of NMEA sentences.
+
+    Tuple of asyncio stream reader and function closing the source is
+    returned.
+
+    :param source: Source of NMEA sentences, see `ingest`.
+    """
+    loop = asyncio.get_event_loop()
+
+    m = RE_TCP.match(source)
+    if m:
+        host = m.group('host').strip('[]')  # IPv6 address in brackets
+        port = int(m.group('port'))
+        reader, writer = await asyncio.open_connection(host, port)
+        return reader, writer.close
+
+    f = sys.stdin.buffer if source == '-' else open(source, 'rb', buffering=0)
+    if stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+        # pipe transport does not support regular files
+        return FileReader(f), f.close
+
+    reader = asyncio.StreamReader()
+    protocol = asyncio.StreamReaderProtocol(reader)
+    transport, _ = await loop.connect_read_pipe(lambda: protocol, f)
+    return reader, transport.close
+
+class FileReader:
+    """
+    Reader of regular file.
+
+    The file is read by executor, so reading does not block event loop.
+    The reader implements `read` method of asyncio stream reader.
+    """
+    def __init__(self, f):
+        self._file = f
+
+    async def read(self, n=-1):
+        """
+        Read at most `n` bytes from the file.
+        """
+        loop = asyncio.get_event_loop()
+        return (await loop.run_in_executor(None, self._file.read, n))
+
+async def write_pos(dev, queue, flush_size, flush_interval):
+    """
+    Save batches of positions from a queue in a database.
+
+    Positions are saved when there are at least `flush_size` positions
+    waiting or the oldest waiting position waits for `flush_interval`
+    seconds. Writing stops when `None` is received from the queue.
+
+    If the positions cannot be saved, then saving is retried. The queue is
+    not read meanwhile.
+
+    :param dev: Device from which positions where obtained.
+    :param queue: Queue of batches of positions.
+    :param flush_size: Number of positions, which triggers write to
+        a database.
+    :param flush_interval: Maximum time [s] positions wait before write
+        to a database.
+    """
+    loop = asyncio.get_event_loop()
+    pending = []
+    size = 0
+    deadline = None
+    get = None
+    done = False
+    while not done:
+        if get is None:
+            get = asyncio.ensure_future(queue.get())
+
+        timeout = None if deadline is None else max(0, deadline - loop.time())
+        await asyncio.wait([get], timeout=timeout)
+        if get.done():
+            batch = get.result()
+            get = None
+            if batch is None:
+                done = True
+            else:
+                pending.append(batch)
+                size += len(batch)
+                if deadline is None:
+                    deadline = loop.time() + flush_interval
+
+        if pending and (done or size >= flush_size or loop.time() >= deadline):
+            await flush(dev, PositionBatch.concat(pending))
+            pending = []
+            size = 0
+            deadline = None
+
+async def flush(dev, batch):
+    """
+    Save batch of positions in a database, retry on failure.
+    """
+    delay = RECONNECT_MIN
+    while True:
+        try:
+            await save_batches(dev, to_async([batch]))
+            return
+        except (OSError, asyncpg.ConnectionDoesNotExistError) as ex:
+            logger.warning('cannot save positions: {}; retry in {}s'.format(
+                ex, delay
+            ))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+
+# vim: sw=4:et:ai
@@ -19,53 +19,305 @@
 
 import asyncio
 import cairocffi as cairo
-import functools
 import geotiler
+import hashlib
 import logging
 import math
-import redis
-from geotiler.cache import redis_downloader
+import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor
+from antrak import stats
 from antrak.dao import map as map_dao
+from antrak.dao import track as track_dao
 from antrak.db import tx
 
 logger = logging.getLogger(__name__)
 
 FMT_MAP_FILENAME = '{0[start]:%Y-%m-%d} - {0[trip]} - {0[name]}.png'.format
+
+# sidecar file with key of rendered map
+FMT_MAP_KEY_FILENAME = '{}.key'.format
 ALPHA = 0.5
 RADIUS = 1
 
+# styles of drawing positions on a map
+STYLES = ('dots', 'line')
+
+# element of cairo path data, which is header of path operation and point
+# of the operation
+PATH_DTYPE = np.dtype([
+    ('type', 'i4'),
+    ('length', 'i4'),
+    ('pad', 'f8'),
+    ('x', 'f8'),
+    ('y', 'f8'),
+])
+
+# maximum number of maps waiting for rendering
+MAX_PENDING = 2
+
+# size of grid cell, used to reduce number of positions, relative to size
+# of map image pixel
+GRID_SCALE = 0.5
+
 @tx
-async def render(dev, query, provider, size):
-    client = redis.Redis('localhost')
-    downloader = redis_downloader(client)
-    render = functools.partial(render_map, downloader, provider, size)
-
-    data = await map_dao.load_pos(dev, query)
-    tasks = (
-        render(item['positions'], item['extent'], FMT_MAP_FILENAME(item))
-        for item in data
-    )
-    return (await asyncio.gather(*tasks))
+async def render(
+        dev, query, provider, size, cache,
+        style='dots', lod=True, jobs=1, force=False, mode='text'
+    ):
+    """
+    Render maps of tracks matching a query.
+
+    Positions of tracks are loaded one track at a time. A map of a track
+    is rendered while positions of next track are loaded. At most
+    `MAX_PENDING * jobs` maps are rendered at once.
+
+    Map tiles are downloaded asynchronously. If number of jobs is greater
+    than one, then drawing of positions and PNG encoding of maps is
+    performed by a pool of processes.
+
+    If level of detail reduction is enabled, then positions are snapped
+    to a grid with cell size of `GRID_SCALE` of map image pixel by
+    a database and only positions in distinct grid cells are loaded.
+
+    Map is not rendered if it exists and its key, saved in sidecar file,
+    is not changed. The key is digest of fingerprint of track positions
+    and map parameters.
+
+    :param dev: Device from which positions where obtained.
+    :param query: Trip and track name query.
+    :param provider: Map provider id.
+    :param size: Size of map image.
+    :param cache: Cache of map tiles.
+    :param style: Style of drawing positions, see `STYLES`.
+    :param lod: Reduce level of detail of positions to map resolution.
+    :param jobs: Number of processes drawing maps.
+    :param force: Render maps even if not changed.
+    :param mode: Search mode of the query, see `SEARCH_MODES`.
+    """
+    downloader = cache.downloader()
+    sem = asyncio.Semaphore(MAX_PENDING * jobs)
 
-async def render_map(downloader, provider, size, positions, extent, output):
-    logger.debug('rendering map {}: {}'.format(output, extent))
-    mm = geotiler.Map(size=size, extent=extent, provider=provider)
-    img = await geotiler.render_map_async(mm, downloader=downloader)
+    await track_dao.update_stats(dev, query=query, mode=mode, missing=True)
+    tracks = await map_dao.find_tracks(dev, query, mode=mode)
 
+    executor = ProcessPoolExecutor(jobs) if jobs > 1 else None
+    tasks = []
+    skipped = 0
+    try:
+        for item in tracks:
+            output = FMT_MAP_FILENAME(item)
+            key = map_key(item['fingerprint'], provider, size, style, lod)
+            if not force and read_key(output) == key:
+                skipped += 1
+                continue
+
+            await sem.acquire()
+
+            mm = geotiler.Map(
+                size=size, extent=item['extent'], provider=provider
+            )
+            cell = pixel_size(mm) * GRID_SCALE if lod else None
+            positions = await map_dao.load_pos(
+                dev, item['start'], item['end'], cell=cell
+            )
+            task = render_map(
+                downloader, mm, positions, output,
+                style=style, executor=executor, key=key,
+            )
+            task = asyncio.ensure_future(task)
+            task.add_done_callback(lambda t: sem.release())
+            tasks.append(task)
+
+        await asyncio.gather(*tasks)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        logger.info('unchanged maps skipped: {}'.format(skipped))
+        logger.info('map tiles cache: {}'.format(', '.join(
+            '{}={}'.format(k, cache.stats[k])
+            for k in ('hit', 'miss', 'eviction')
+        )))
+
+async def render_map(
+        downloader, mm, positions, output,
+        style='dots', executor=None, key=None
+    ):
+    """
+    Render map of positions and save it as PNG file.
+
+    :param downloader: Map tiles downloader.
+    :param mm: Map object.
+    :param positions: Array of longitude and latitude of positions.
+    :param output: Output file name.
+    :param style: Style of drawing positions, see `STYLES`.
+    :param executor: Executor of map drawing, draw in current thread if
+        null.
+    :param key: Key of the map saved in sidecar file if not null.
+    """
+    logger.debug('rendering map {}: {}, {} positions'.format(
+        output, mm.extent, len(positions)
+    ))
+    with stats.timer('render', len(positions)):
+        img = await geotiler.render_map_async(mm, downloader=downloader)
+        points = rev_geocode(mm, positions)
+
+        if executor is None:
+            draw_map(img, points, output, style)
+        else:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(
+                executor, draw_map, img, points, output, style
+            )
+    if key is not None:
+        save_key(output, key)
+    logger.debug('written {}'.format(output))
+
+def draw_map(img, points, output, style='dots'):
+    """
+    Draw positions on map image and save it as PNG file.
+
+    :param img: Map image.
+    :param points: Array of x and y coordinates of positions on map image.
+    :param output: Output file name.
+    :param style: Style of drawing positions, see `STYLES`.
+    """
     buff = bytearray(img.convert('RGBA').tobytes('raw', 'BGRA'))
     surface = cairo.ImageSurface.create_for_data(
-        buff, cairo.FORMAT_ARGB32, *size
+        buff, cairo.FORMAT_ARGB32, *img.size
     )
     cr = cairo.Context(surface)
+    draw_pos(cr, points, style)
+    surface.write_to_png(output)
 
-    points = (mm.rev_geocode(p) for p in positions)
-    for x, y in points:
-        cr.set_source_rgba(1.0, 0.0, 0.0, ALPHA)
-        cr.arc(x, y, RADIUS, 0, 2 * math.pi)
-        cr.fill()
-        cr.stroke()
+def map_key(fingerprint, provider, size, style, lod):
+    """
+    Calculate key of a map.
 
-    surface.write_to_png(output)
-    logger.debug('written {}'.format(output))
+    :param fingerprint: Fingerprint of track positions.
+    :param provider: Map provider id.
+    :param size: Size of map image.
+    :param style: Style of drawing positions.
+    :param lod: Level of detail reduction flag.
+    """
+    value = '{}|{}|{}x{}|{}|{}'.format(
+        fingerprint, provider, size[0], size[1], style, lod
+    )
+    return hashlib.sha1(value.encode()).hexdigest()
+
+def read_key(output):
+    """
+    Read key of rendered map from its sidecar file.
+
+    Null is returned if the map or its sidecar file does not exist.
+
+    :param output: Map file name.
+    """
+    if not os.path.exists(output):
+        return None
+    try:
+        with open(FMT_MAP_KEY_FILENAME(output)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def save_key(output, key):
+    """
+    Save key of rendered map in its sidecar file.
+
+    :param output: Map file name.
+    :param key: Key of the map.
+    """
+    with open(FMT_MAP_KEY_FILENAME(output), 'w') as f:
+        f.write(key + '\n')
+
+def rev_geocode(mm, positions):
+    """
+    Calculate positions on map image.
+
+    Positions are projected with spherical Mercator projection and scaled
+    to map image coordinates. The scale and offset are calculated with
+    reverse geocoding of reference locations by the map.
+
+    Array of x and y coordinates of positions on map image is returned.
+
+    :param mm: Map object.
+    :param positions: Array of longitude and latitude of positions.
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    ref = np.array([(0, 0), (90, 45)], dtype=np.float64)
+    ref_xy = np.array([mm.rev_geocode(p) for p in ref])
+
+    ref = mercator(ref)
+    scale = (ref_xy[1] - ref_xy[0]) / (ref[1] - ref[0])
+    return (mercator(positions) - ref[0]) * scale + ref_xy[0]
+
+def pixel_size(mm):
+    """
+    Calculate size of map image pixel in radians of spherical Mercator
+    projection.
+
+    :param mm: Map object.
+    """
+    ref = np.array([(0, 0), (90, 0)], dtype=np.float64)
+    x0, x1 = (mm.rev_geocode(p)[0] for p in ref)
+    return (math.pi / 2) / (x1 - x0)
+
+def mercator(positions):
+    """
+    Project positions with spherical Mercator projection.
+
+    :param positions: Array of longitude and latitude of positions.
+    """
+    lon = np.radians(positions[:, 0])
+    lat = np.radians(positions[:, 1])
+    return np.column_stack([lon, np.log(np.tan(np.pi / 4 + lat / 2))])
+
+def draw_pos(cr, points, style='dots'):
+    """
+    Draw positions on map image as single cairo path.
+
+    The path is created with NumPy and appended to cairo context at once.
+    Positions are drawn as dots or as a line, see `STYLES`. Dot is a line
+    of zero length with round cap.
+
+    :param cr: Cairo context.
+    :param points: Array of x and y coordinates of positions on map image.
+    :param style: Style of drawing positions, see `STYLES`.
+    """
+    n = len(points)
+    if not n:
+        return
+
+    if style == 'dots':
+        data = np.zeros(2 * n, dtype=PATH_DTYPE)
+        data['type'][::2] = cairo.PATH_MOVE_TO
+        data['type'][1::2] = cairo.PATH_LINE_TO
+        data['x'] = np.repeat(points[:, 0], 2)
+        data['y'] = np.repeat(points[:, 1], 2)
+        cr.set_line_width(2 * RADIUS)
+        cr.set_line_cap(cairo.LINE_CAP_ROUND)
+    elif style == 'line':
+        data = np.zeros(n, dtype=PATH_DTYPE)
+        data['type'] = cairo.PATH_LINE_TO
+        data['type'][0] = cairo.PATH_MOVE_TO
+        data['x'] = points[:, 0]
+        data['y'] = points[:, 1]
+        cr.set_line_width(RADIUS)
+        cr.set_line_join(cairo.LINE_JOIN_ROUND)
+    else:
+        raise ValueError('Unknown style: {}'.format(style))
+
+    # each element of the array is header and point of path data
+    data['length'] = 2
+    path = cairo.ffi.new('cairo_path_t *', {
+        'status': cairo.STATUS_SUCCESS,
+        'data': cairo.ffi.from_buffer('cairo_path_data_t[]', data),
+        'num_data': 2 * len(data),
+    })
+    cairo.cairo.cairo_append_path(cr._pointer, path)
+
+    cr.set_source_rgba(1.0, 0.0, 0.0, ALPHA)
+    cr.stroke()
 
 # vim: sw=4:et:ai
@@ -22,12 +22,28 @@ import operator
 from datetime import timedelta
 
 from antrak.dao import report as report_dao
+from antrak.dao import track as track_dao
 from antrak.db import tx
 
 FMT_TRACK_STATS = ' {:%Y-%m-%d} {:%H:%M:%S} {:%H:%M:%S}  {:30}  {}  {:4} km {:4} km/h'.format
 
-async def track_stats(dev, query):
-    data = await report_dao.track_summary(dev, query)
+@tx
+async def track_stats(dev, query, recompute=False, mode='text'):
+    """
+    Print statistics of tracks matching a query.
+
+    Statistics of tracks are maintained when positions are imported and
+    tracks are added. Missing statistics are calculated on demand.
+
+    :param dev: Device from which positions where obtained.
+    :param query: Trip and track name query.
+    :param recompute: Recalculate statistics of the tracks.
+    :param mode: Search mode of the query, see `SEARCH_MODES`.
+    """
+    await track_dao.update_stats(
+        dev, query=query, mode=mode, missing=not recompute
+    )
+    data = await report_dao.track_summary(dev, query, mode=mode)
     data = itertools.groupby(data, operator.itemgetter('trip'))
 
     for trip, items in data:
@@ -17,60 +17,550 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import itertools
-from toolz.itertoolz import sliding_window
+import asyncio
+import hashlib
+import logging
+import numpy as np
+import os.path
+import tempfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
 
+from antrak import gpx, nmea, stats
+from antrak.dao import manifest as manifest_dao
 from antrak.dao import track as track_dao
 from antrak.db import tx
-from antrak.nmea import parse_pos
-from antrak.util import flatten
+from antrak.position import PositionBatch
+from antrak.segment import Segmenter
+from antrak.util import flatten, to_async
+
+logger = logging.getLogger(__name__)
 
 FMT_TRACK_LIST = '{:%Y-%m-%d} {} {}'.format
 
-def filter_quality(positions):
+# name of detected track
+FMT_TRACK_NAME = '{:%Y-%m-%d %H:%M:%S}'.format
+
+# default trip name of detected tracks
+DETECT_TRIP = 'detected'
+
+# default maximum value of dilution of precision
+MAX_DOP = 5
+
+# default maximum altitude speed [m/s]
+MAX_ALT_SPEED = 10
+
+# default maximum time difference between positions [s], for which
+# altitude speed is checked
+ALT_SPEED_PERIOD = 10
+
+# size of file regions used to calculate hash of file content
+HASH_WINDOW = 64 * 1024
+
+# parsers of supported file formats
+PARSERS = {
+    'nmea': nmea.parse_pos,
+    'gpx': gpx.parse_points,
+}
+
+def parse_file(fn, fmt=None, entry=None, max_dop=MAX_DOP):
+    """
+    Read batches of positions from a file.
+
+    If import manifest entry of the file is specified, then reading of
+    the file is resumed from the offset stored in the entry, see
+    `resume_offset`. The entry is updated when the file is read. Reading
+    of GPX files is not resumed, but unchanged GPX file is skipped.
+
+    The offset stored in the entry is the offset of epoch of the last
+    good quality position of NMEA file. The position is kept back by
+    `AltitudeSpeedFilter`, so it is read again and checked with next
+    positions when the file grows.
+
+    :param fn: File name.
+    :param fmt: File format, if not specified then GPX format is assumed
+        for files with `.gpx` extension and NMEA format otherwise.
+    :param entry: Import manifest entry of the file.
+    :param max_dop: Maximum value of dilution of precision.
+    """
+    if fmt is None:
+        fmt = 'gpx' if fn.lower().endswith('.gpx') else 'nmea'
+
+    with open(fn, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        offset = 0 if entry is None else resume_offset(f, entry)
+        if fmt == 'nmea':
+            f.seek(offset)
+            parser = nmea.Parser(offset)
+            batches = nmea.parse_pos(f, parser=parser)
+        elif offset < stat.st_size:
+            offset = 0
+            batches = stats.timed_iter('parse', PARSERS[fmt](f))
+        else:
+            batches = ()
+
+        last = entry.get('timestamp') if entry else None
+        held = None
+        for batch in batches:
+            if len(batch):
+                last = batch['timestamp'][-1].item().replace(tzinfo=timezone.utc)
+                if fmt == 'nmea':
+                    idx = np.flatnonzero(quality_mask(batch, max_dop))
+                    if len(idx):
+                        held = parser.batch_offsets[idx[-1]]
+            yield batch
+
+        if entry is not None:
+            if fmt != 'nmea':
+                end = stat.st_size
+            elif held is not None:
+                end = held
+            else:
+                end = parser.offset
+            entry.update(
+                path=os.path.abspath(fn),
+                inode=stat.st_ino,
+                size=stat.st_size,
+                hash=file_hash(f, end),
+                offset=end,
+                timestamp=last,
+            )
+
+def file_hash(f, offset):
+    """
+    Calculate hash of file content before an offset.
+
+    To avoid reading of whole file, only the first and the last
+    `HASH_WINDOW` bytes before the offset are used.
+
+    :param f: Binary file object.
+    :param offset: File offset.
+    """
+    h = hashlib.sha1()
+    f.seek(0)
+    h.update(f.read(min(offset, HASH_WINDOW)))
+    start = max(HASH_WINDOW, offset - HASH_WINDOW)
+    if start < offset:
+        f.seek(start)
+        h.update(f.read(offset - start))
+    return h.digest()
+
+def resume_offset(f, entry):
+    """
+    Find offset of a file, from which it should be read, using import
+    manifest entry of the file.
+
+    If the file is replaced, truncated or its content changed, then zero
+    is returned.
+
+    :param f: Binary file object.
+    :param entry: Import manifest entry of the file.
+    """
+    if not entry:
+        return 0
+
+    offset = entry['offset']
+    stat = os.fstat(f.fileno())
+    if stat.st_ino != entry['inode'] or stat.st_size < offset \
+            or file_hash(f, offset) != entry['hash']:
+        logger.info('file {} changed, reading from start'.format(entry['path']))
+        return 0
+
+    logger.debug('resume reading of file {} at {}'.format(entry['path'], offset))
+    return offset
+
+def filter_quality(batches, max_dop=MAX_DOP, rejected=None):
     """
     Filter out bad quality positions.
 
     3D, good positions are kept - for `good` definition see Wikipedia
     article about `dilution of precision
     <https://en.wikipedia.org/wiki/Dilution_of_precision_(navigation)>`_.
+
+    Unknown (NaN) dilution of precision values are not used to reject a
+    position.
+
+    :param batches: Collection of batches of positions.
+    :param max_dop: Maximum value of dilution of precision.
+    :param rejected: Optional counter of rejected positions.
+    """
+    for batch in batches:
+        with stats.timer('filter', len(batch)):
+            result = batch[quality_mask(batch, max_dop)]
+        if rejected is not None:
+            rejected['quality'] += len(batch) - len(result)
+        yield result
+
+def quality_mask(batch, max_dop=MAX_DOP):
+    """
+    Check quality of positions.
+
+    Array of boolean values is returned. A value is true for 3D, good
+    position, see `filter_quality`.
+
+    :param batch: Batch of positions.
+    :param max_dop: Maximum value of dilution of precision.
+    """
+    return batch['is_3d'] \
+        & ~(batch['hdop'] >= max_dop) \
+        & ~(batch['vdop'] >= max_dop) \
+        & ~(batch['pdop'] >= max_dop)
+
+def check_altitude_speed(
+        ts, alt, max_alt_speed=MAX_ALT_SPEED, period=ALT_SPEED_PERIOD
+    ):
+    """
+    Check altitude speed between consecutive positions.
+
+    Array of boolean values is returned. A value is true if altitude speed
+    between position and next position is acceptable or if time
+    difference between the positions is at least `period` seconds.
+    Unknown (NaN) altitude is not used to reject a position.
+
+    :param ts: Array of timestamps of positions.
+    :param alt: Array of altitudes of positions.
+    :param max_alt_speed: Maximum altitude speed [m/s].
+    :param period: Maximum time difference between positions [s], for
+        which altitude speed is checked.
+    """
+    td = np.abs(np.diff(ts)) / np.timedelta64(1, 's')
+    dz = np.abs(np.diff(alt))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (td >= period) | (dz / td < max_alt_speed) | np.isnan(dz)
+
+class AltitudeSpeedFilter:
+    """
+    Filter out positions, which altitude changes too fast.
+
+    Creates a callable, which filters batch of positions. The last
+    position of a batch is kept by the filter until next batch is
+    processed, so the positions are checked across batch boundaries.
+
+    A position is kept if altitude speed between the position and next
+    position is acceptable. The last position is always rejected. When
+    positions are imported from files, the last position is read again
+    by next import, see `parse_file`.
+
+    :var max_alt_speed: Maximum altitude speed [m/s].
+    :var period: Maximum time difference between positions [s], for
+        which altitude speed is checked.
+    :var rejected: Optional counter of rejected positions.
+    :var last: Last position of previously processed batch.
+    """
+    def __init__(
+            self,
+            max_alt_speed=MAX_ALT_SPEED,
+            period=ALT_SPEED_PERIOD,
+            rejected=None
+        ):
+        self.max_alt_speed = max_alt_speed
+        self.period = period
+        self.rejected = rejected
+        self.last = PositionBatch.empty()
+
+    def __call__(self, batch):
+        with stats.timer('filter'):
+            batch = PositionBatch.concat([self.last, batch])
+            if not len(batch):
+                return batch
+
+            mask = check_altitude_speed(
+                batch['timestamp'], batch['alt'], self.max_alt_speed,
+                self.period
+            )
+            self.last = batch[-1:]
+            result = batch[:-1][mask]
+        if self.rejected is not None:
+            self.rejected['altitude_speed'] += len(batch) - 1 - len(result)
+        return result
+
+    def close(self):
+        """
+        Reject the last position.
+        """
+        if self.rejected is not None:
+            self.rejected['altitude_speed'] += len(self.last)
+        self.last = PositionBatch.empty()
+
+def filter_altitude_speed(
+        batches,
+        max_alt_speed=MAX_ALT_SPEED,
+        period=ALT_SPEED_PERIOD,
+        rejected=None,
+    ):
+    """
+    Filter out positions, which altitude changes too fast.
+
+    See `AltitudeSpeedFilter` for details.
+
+    :param batches: Collection of batches of positions.
+    :param max_alt_speed: Maximum altitude speed [m/s].
+    :param period: Maximum time difference between positions [s], for
+        which altitude speed is checked.
+    :param rejected: Optional counter of rejected positions.
+    """
+    check = AltitudeSpeedFilter(max_alt_speed, period, rejected)
+    yield from (check(b) for b in batches)
+    check.close()
+
+def log_rejected(rejected):
+    """
+    Log number of rejected positions and record them as dropped by
+    `filter` stage.
+
+    :param rejected: Counter of rejected positions.
+    """
+    logger.info('rejected positions: {}'.format(', '.join(
+        '{}={}'.format(k, rejected[k]) for k in ('quality', 'altitude_speed')
+    )))
+    for reason, n in rejected.items():
+        stats.drop('filter', reason, n)
+
+def parse_filter_file(fn, fmt, entry, max_dop, spool, collect=False):
+    """
+    Read positions from a file, filter out bad quality positions and
+    write the batches of positions into a spool file.
+
+    The batches are written one by one, so memory used by the function
+    does not grow with size of the file.
+
+    Tuple of spool file name, number of batches, number of rejected
+    positions, updated import manifest entry of the file and statistics
+    of stages is returned. The function is executed by worker processes
+    of parallel import.
+
+    :param spool: Directory of spool files.
+    :param collect: Collect statistics of stages, see `antrak.stats`.
+    """
+    if collect:
+        stats.enable()
+    rejected = Counter()
+    batches = parse_file(fn, fmt, entry, max_dop)
+    batches = filter_quality(batches, max_dop, rejected)
+
+    fd, spool_fn = tempfile.mkstemp(dir=spool)
+    n = 0
+    with open(fd, 'wb') as f:
+        for batch in batches:
+            if len(batch):
+                np.save(f, batch.data)
+                n += 1
+    return spool_fn, n, rejected['quality'], entry, stats.collect()
+
+def read_spool(fn, n):
+    """
+    Read batches of positions from a spool file and remove the file.
+
+    :param fn: Spool file name.
+    :param n: Number of batches in the spool file.
+    """
+    try:
+        with open(fn, 'rb') as f:
+            for _ in range(n):
+                yield PositionBatch(np.load(f))
+    finally:
+        os.unlink(fn)
+
+async def parse_parallel(files, fmt, entries, max_dop, jobs, rejected):
+    """
+    Read positions from files and filter out bad quality positions using
+    pool of worker processes.
+
+    Files are parsed in parallel, but batches of positions are returned
+    in order of the files. At most `2 * jobs` files are parsed ahead of
+    the consumer of the batches. The worker processes write the batches
+    into spool files in a temporary directory, which are read batch by
+    batch, so memory use does not grow with size of the files.
+    Statistics of stages of the worker processes are merged into
+    statistics of current process.
+
+    :param files: Collection of file names.
+    :param fmt: Format of the files, see `parse_file`.
+    :param entries: Import manifest entries of the files, updated when
+        the files are read.
+    :param max_dop: Maximum value of dilution of precision.
+    :param jobs: Number of worker processes.
+    :param rejected: Counter of rejected positions.
+    """
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue(2 * jobs)
+
+    async def submit(executor, spool):
+        for fn, entry in zip(files, entries):
+            task = loop.run_in_executor(
+                executor, parse_filter_file, fn, fmt, entry, max_dop,
+                spool, stats.enabled()
+            )
+            await queue.put((task, entry))
+        await queue.put(None)
+
+    # spool directory is removed after the worker processes finish
+    with tempfile.TemporaryDirectory(prefix='antrak-') as spool, \
+            ProcessPoolExecutor(jobs) as executor:
+        producer = asyncio.ensure_future(submit(executor, spool))
+        try:
+            item = await queue.get()
+            while item is not None:
+                task, entry = item
+                spool_fn, n, count, result, data = await task
+                entry.update(result)
+                rejected['quality'] += count
+                stats.merge(data)
+                for batch in read_spool(spool_fn, n):
+                    yield batch
+                item = await queue.get()
+        finally:
+            producer.cancel()
+
+@tx
+async def save_pos(
+        dev,
+        files,
+        fmt=None,
+        jobs=1,
+        full=False,
+        max_dop=MAX_DOP,
+        max_alt_speed=MAX_ALT_SPEED,
+        alt_speed_period=ALT_SPEED_PERIOD,
+        detect=None,
+    ):
+    """
+    Import positions from NMEA or GPX files into a database.
+
+    Import manifest is used to resume reading of previously imported
+    files, see `parse_file`. Positions already existing in the database
+    are ignored.
+
+    If number of jobs is greater than one, then the files are parsed
+    with pool of worker processes while positions are saved in
+    a database.
+
+    :param dev: Device from which positions where obtained.
+    :param files: Collection of file names.
+    :param fmt: Format of the files, see `parse_file`.
+    :param jobs: Number of worker processes parsing the files.
+    :param full: Read files from start, ignoring import manifest.
+    :param max_dop: Maximum value of dilution of precision.
+    :param max_alt_speed: Maximum altitude speed [m/s].
+    :param alt_speed_period: Maximum time difference between positions
+        [s], for which altitude speed is checked.
+    :param detect: Detect tracks after import with trip name and
+        detection parameters if specified, see `track_detect`.
     """
-    return (
-        p for p in positions
-        if p.properties['is_3d']
-            and p.properties['hdop'] < 5
-            and p.properties['vdop'] < 5
-            and p.properties['pdop'] < 5
-    )
-
-def check_altitude_speed(p1, p2):
-    td = abs(p2.properties['timestamp'] - p1.properties['timestamp']).total_seconds()
-    # TODO: make time difference and altitude speed limits configurable
-    return td >= 10 or abs(p2.z - p1.z) / td < 10
-
-def filter_altitude_speed(positions):
-    return (
-        p1 for p1, p2 in sliding_window(2, positions)
-        if check_altitude_speed(p2, p1)
-    )
+    paths = [os.path.abspath(fn) for fn in files]
+    manifest = {} if full else await manifest_dao.find(dev, paths)
+    entries = [manifest.get(p, {}) for p in paths]
+
+    rejected = Counter()
+    if jobs > 1:
+        batches = parse_parallel(files, fmt, entries, max_dop, jobs, rejected)
+    else:
+        items = zip(files, entries)
+        batches = flatten(parse_file(fn, fmt, e, max_dop) for fn, e in items)
+        batches = to_async(filter_quality(batches, max_dop, rejected))
+
+    check = AltitudeSpeedFilter(max_alt_speed, alt_speed_period, rejected)
+    batches = (check(b) async for b in batches)
+    await save_batches(dev, batches)
+    check.close()
+
+    await manifest_dao.save(dev, entries)
+
+    log_rejected(rejected)
+
+    if detect is not None:
+        await track_detect(dev, **detect)
 
 @tx
-def save_pos(dev, files):
-    positions = flatten(parse_pos(open(fn)) for fn in files)
-    positions = (p for p in positions if p)
-    positions = filter_quality(positions)
-    positions = filter_altitude_speed(positions)
-    return track_dao.save_pos(dev, positions)
+async def save_batches(dev, batches):
+    """
+    Save batches of positions in a database and update statistics of
+    tracks overlapping time period of the positions.
+
+    :param dev: Device from which positions where obtained.
+    :param batches: Asynchronous iterable of batches of positions.
+    """
+    period = []
+    async def scan(batches):
+        async for batch in batches:
+            if len(batch):
+                ts = batch['timestamp']
+                period.extend((ts.min(), ts.max()))
+            yield batch
+
+    await track_dao.save_pos(dev, scan(batches))
+    if period:
+        start, end = (
+            t.item().replace(tzinfo=timezone.utc)
+            for t in (min(period), max(period))
+        )
+        await track_dao.update_stats(dev, start=start, end=end)
 
 @tx
 async def track_set(dev, trip, name, start, end):
     start, end = await track_dao.find_period(dev, start, end)
-    task = await track_dao.add(dev, trip, name, start, end)
-    return task
+    await track_dao.add(dev, trip, name, start, end)
+    await track_dao.update_stats(dev, trip=trip, name=name)
+
+@tx
+async def track_detect(dev, trip=DETECT_TRIP, **params):
+    """
+    Detect tracks in positions newer than the last track and save them.
+
+    Positions are read in one pass ordered by timestamp, see
+    `antrak.segment` module for track detection details. The detected
+    tracks are named with their start time. A detected track is not saved
+    if a track with the same name exists, and a warning is logged.
+
+    The last detected track is not saved if it ends within maximum gap
+    from current time, i.e. it is still being recorded.
+
+    :param dev: Device from which positions where obtained.
+    :param trip: Trip name of detected tracks.
+    :param params: Track detection parameters, see `Segmenter`.
+    """
+    segmenter = Segmenter(**params)
+    since = await track_dao.last_end(dev)
+    logger.debug('detecting tracks since {}'.format(since))
+
+    tracks = []
+    async for data in track_dao.load_motion(dev, since):
+        ts = data['timestamp'].astype('datetime64[us]')
+        items = segmenter.feed(ts, data['lon'], data['lat'], data['speed'])
+        tracks.extend(items)
+
+    last = segmenter.close()
+    now = np.datetime64(datetime.utcnow(), 'us')
+    age = (now - last[0][1]) / np.timedelta64(1, 's') if last else 0
+    if age > segmenter.max_gap:
+        tracks.extend(last)
+
+    if not tracks:
+        return
+
+    tracks = [(to_datetime(s), to_datetime(e)) for s, e, _ in tracks]
+    tracks = [(FMT_TRACK_NAME(s), s, e) for s, e in tracks]
+    added = await track_dao.add_tracks(dev, trip, tracks)
+    await track_dao.update_stats(dev, start=tracks[0][1], end=tracks[-1][2])
+
+    logger.info('detected {} tracks'.format(len(tracks)))
+    for name, start, end in tracks:
+        if name in added:
+            print(FMT_TRACK_LIST(start, trip, name))
+        else:
+            logger.warning('track {} - {} exists, ignored track from {} to {}'
+                .format(trip, name, start, end))
+
+def to_datetime(ts):
+    """
+    Convert NumPy timestamp into timezone aware datetime object.
+    """
+    return ts.item().replace(tzinfo=timezone.utc)
 
 @tx
-async def track_list(dev, query=''):
-    data = await track_dao.track_list(dev, query=query)
+async def track_list(dev, query='', mode='text'):
+    data = await track_dao.track_list(dev, query=query, mode=mode)
     for item in data:
         print(FMT_TRACK_LIST(item['start'], item['trip'], item['name']))
 
@@ -0,0 +1,287 @@
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Export of positions with binary `COPY` command.
+
+All exported columns have fixed size and are not null, so each row of
+binary `COPY` output has the same size and chunks of the output are
+decoded with NumPy without parsing of individual rows.
+"""
+
+import logging
+import numpy as np
+
+from antrak import stats
+from antrak.dao.search import match_cond, SQL_MATCH_TRACK
+from antrak.db import tx
+
+logger = logging.getLogger(__name__)
+
+# exported columns of positions and their PostgreSQL binary format;
+# timestamp is number of microseconds since PostgreSQL epoch
+EXPORT_COLUMNS = (
+    ('timestamp', '>i8'),
+    ('lon', '>f8'),
+    ('lat', '>f8'),
+    ('alt', '>f8'),
+    ('heading', '>f8'),
+    ('speed', '>f8'),
+    ('step_distance', '>f8'),
+    ('time_delta', '>f8'),
+    ('vertical_speed', '>f8'),
+    ('cum_distance', '>f8'),
+)
+
+# index of track, which position belongs to
+TRACK_COLUMN = ('track', '>i4')
+
+SQL_EXPORT_COLUMNS = """
+    p.timestamp, st_x(p.location), st_y(p.location),
+    coalesce(st_z(p.location), 'NaN'), p.heading, p.speed,
+    coalesce(p.step_distance, 'NaN'), coalesce(p.time_delta, 'NaN'),
+    coalesce(p.vertical_speed, 'NaN'), coalesce(p.cum_distance, 'NaN')
+"""
+
+SQL_EXPORT_POS = """
+select {}
+from position p
+where p.device = $1
+    and p.timestamp >= coalesce($2::timestamptz, '-infinity')
+    and p.timestamp <= coalesce($3::timestamptz, 'infinity')
+order by p.timestamp
+""".format(SQL_EXPORT_COLUMNS)
+
+# tracks overlapping time period
+SQL_TRACK_PERIOD = """
+and t.end >= coalesce($3::timestamptz, '-infinity')
+and t.start <= coalesce($4::timestamptz, 'infinity')
+"""
+
+SQL_EXPORT_TRACKS = """
+with {}
+select trip, name, start, "end"
+from match_track
+order by start, trip, name
+"""
+
+SQL_EXPORT_TRACK_POS = """
+with {{}}, track_id as (
+    select (row_number() over (order by start, trip, name) - 1)::int4 as id,
+        device, start, "end"
+    from match_track
+)
+select t.id, {}
+from track_id t
+    inner join position p on t.device = p.device
+        and p.timestamp between t.start and t.end
+where p.timestamp >= coalesce($3::timestamptz, '-infinity')
+    and p.timestamp <= coalesce($4::timestamptz, 'infinity')
+order by t.id, p.timestamp
+""".format(SQL_EXPORT_COLUMNS)
+
+# PostgreSQL epoch (2000-01-01) as number of microseconds since Unix epoch
+PG_EPOCH = 946684800000000
+
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+COPY_HEADER_SIZE = len(COPY_SIGNATURE) + 8
+COPY_TRAILER = b'\xff\xff'
+
+# minimum size of buffered binary data before it is decoded [bytes]
+DECODE_SIZE = 2 ** 20
+
+class CopyDecoder:
+    """
+    Decoder of output of binary `COPY` command with fixed size, not null
+    columns.
+
+    Chunks of data are fed to the decoder and NumPy structured array is
+    returned for the complete rows of the data.
+
+    :var columns: Collection of column names and their binary format.
+    :var dtype: NumPy data type of rows of binary data.
+    :var result_dtype: NumPy data type of decoded rows.
+    """
+    def __init__(self, columns):
+        self.columns = columns
+        fields = [('count', '>i2')]
+        for name, fmt in columns:
+            fields.extend([(name + '_size', '>i4'), (name, fmt)])
+        self.dtype = np.dtype(fields)
+        self.result_dtype = np.dtype([
+            (name, 'datetime64[us]' if name == 'timestamp' else fmt[1:])
+            for name, fmt in columns
+        ])
+
+        self._header = False
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Decode complete rows of a chunk of binary data.
+
+        :param data: Chunk of output of binary `COPY` command.
+        """
+        buff = self._buffer
+        buff.extend(data)
+
+        if not self._header:
+            if len(buff) < COPY_HEADER_SIZE:
+                return self.empty()
+            if not buff.startswith(COPY_SIGNATURE):
+                raise ValueError('Invalid binary COPY signature')
+            ext = buff[COPY_HEADER_SIZE - 4:COPY_HEADER_SIZE]
+            ext = int.from_bytes(ext, 'big')
+            if len(buff) < COPY_HEADER_SIZE + ext:
+                return self.empty()
+            del buff[:COPY_HEADER_SIZE + ext]
+            self._header = True
+
+        n = len(buff) // self.dtype.itemsize
+        if not n:
+            return self.empty()
+
+        size = n * self.dtype.itemsize
+        rows = np.frombuffer(buff, dtype=self.dtype, count=n)
+        result = self.decode(rows)
+        del rows
+        del buff[:size]
+        return result
+
+    def close(self):
+        """
+        Check that all data has been decoded.
+        """
+        if bytes(self._buffer) != COPY_TRAILER:
+            raise ValueError('Incomplete binary COPY data')
+
+    def decode(self, rows):
+        """
+        Convert rows of binary data into NumPy structured array.
+
+        :param rows: NumPy structured array of rows of binary data.
+        """
+        if (rows['count'] != len(self.columns)).any():
+            raise ValueError('Unexpected number of columns')
+
+        result = np.empty(len(rows), dtype=self.result_dtype)
+        for name, fmt in self.columns:
+            if (rows[name + '_size'] != int(fmt[-1])).any():
+                raise ValueError('Unexpected size of column: {}'.format(name))
+            if name == 'timestamp':
+                value = (rows[name] + PG_EPOCH).view('datetime64[us]')
+            else:
+                value = rows[name]
+            result[name] = value
+        return result
+
+    def empty(self):
+        return np.empty(0, dtype=self.result_dtype)
+
+def export_columns(track=False):
+    """
+    Get columns of exported positions.
+
+    :param track: Include index of track.
+    """
+    return ((TRACK_COLUMN,) if track else ()) + EXPORT_COLUMNS
+
+@tx
+async def find_tracks(dev, query, start=None, end=None, mode='text'):
+    """
+    Find tracks matching a query and overlapping time period.
+
+    :param dev: Device from which positions where obtained.
+    :param query: Trip and track name query.
+    :param start: Start of time period.
+    :param end: End of time period.
+    :param mode: Search mode of the query, see `SEARCH_MODES`.
+    """
+    cond, value = match_cond(query, mode)
+    sql = SQL_EXPORT_TRACKS.format(
+        SQL_MATCH_TRACK.format(cond + SQL_TRACK_PERIOD)
+    )
+    return (await tx.conn.fetch(sql, dev, value, start, end))
+
+@tx
+async def export_pos(
+        dev, write, start=None, end=None, query=None, mode='text'
+    ):
+    """
+    Export positions of a device with binary `COPY` command.
+
+    Positions are decoded in chunks and each chunk is passed to `write`
+    function as NumPy structured array. The memory usage does not depend
+    on the number of positions.
+
+    If query is specified, then positions of tracks matching the query
+    are exported. The positions have additional `track` column, which is
+    index of a track returned by `find_tracks` function.
+
+    Number of exported positions is returned.
+
+    :param dev: Device from which positions where obtained.
+    :param write: Function receiving chunks of positions.
+    :param start: Start of time period.
+    :param end: End of time period.
+    :param query: Trip and track name query.
+    :param mode: Search mode of the query, see `SEARCH_MODES`.
+    """
+    decoder = CopyDecoder(export_columns(query is not None))
+    if query is None:
+        sql = SQL_EXPORT_POS
+        args = dev, start, end
+    else:
+        cond, value = match_cond(query, mode)
+        sql = SQL_EXPORT_TRACK_POS.format(
+            SQL_MATCH_TRACK.format(cond + SQL_TRACK_PERIOD)
+        )
+        args = dev, value, start, end
+
+    count = 0
+    buff = []
+    buff_size = 0
+
+    def flush():
+        nonlocal count, buff_size
+        data = decoder.feed(b''.join(buff))
+        buff.clear()
+        buff_size = 0
+        if len(data):
+            write(data)
+            count += len(data)
+            logger.debug('positions exported: {}'.format(count))
+
+    async def output(data):
+        nonlocal buff_size
+        buff.append(data)
+        buff_size += len(data)
+        if buff_size >= DECODE_SIZE:
+            flush()
+
+    with stats.timer('query') as t:
+        await tx.conn.copy_from_query(
+            sql, *args, output=output, format='binary'
+        )
+        flush()
+        decoder.close()
+        t.count = count
+    return count
+
+# vim: sw=4:et:ai
@@ -0,0 +1,76 @@
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Import manifest - information about imported files.
+"""
+
+import logging
+from antrak.db import tx
+
+logger = logging.getLogger(__name__)
+
+SQL_FIND = """
+select path, inode, size, hash, "offset", timestamp
+from import_file
+where device = $1 and path = any($2)
+"""
+
+SQL_SAVE = """
+insert into import_file (device, path, inode, size, hash, "offset", timestamp)
+values ($1, $2, $3, $4, $5, $6, $7)
+on conflict (device, path) do update
+set inode = excluded.inode,
+    size = excluded.size,
+    hash = excluded.hash,
+    "offset" = excluded."offset",
+    timestamp = excluded.timestamp
+"""
+
+@tx
+async def find(dev, paths):
+    """
+    Find manifest entries of imported files.
+
+    Dictionary of file path and manifest entry is returned.
+
+    :param dev: Device from which positions where obtained.
+    :param paths: Collection of absolute paths of files.
+    """
+    data = await tx.conn.fetch(SQL_FIND, dev, list(paths))
+    return {r['path']: dict(r) for r in data}
+
+@tx
+async def save(dev, entries):
+    """
+    Save manifest entries of imported files.
+
+    :param dev: Device from which positions where obtained.
+    :param entries: Collection of manifest entries.
+    """
+    data = (
+        (
+            dev, e['path'], e['inode'], e['size'], e['hash'], e['offset'],
+            e['timestamp']
+        )
+        for e in entries
+    )
+    await tx.conn.executemany(SQL_SAVE, data)
+
+# vim: sw=4:et:ai
@@ -17,26 +17,110 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import numpy as np
+
+from antrak import stats
+from antrak.dao.search import match_cond, SQL_MATCH_TRACK
 from antrak.db import tx
 
-SQL_LOAD_POS = """
-select t.trip, t.name, t.start,
-    array[
-        min(st_x(p.location)), min(st_y(p.location)),
-        max(st_x(p.location)), max(st_y(p.location))
-    ] as extent,
-    array_agg(array[st_x(p.location), st_y(p.location)]) as positions
-from track t
-    inner join position p on t.device = p.device
-        and p.timestamp between t.start and t.end
-where p.device = $1 and t.trip || ' ' || t.name ~* $2
-group by t.trip, t.name, t.start
+# number of positions fetched at once from a database cursor
+CURSOR_CHUNK = 10000
+
+SQL_FIND_TRACKS = """
+with {}
+select t.trip, t.name, t.start, t.end,
+    array[s.min_lon, s.min_lat, s.max_lon, s.max_lat] as extent,
+    md5(concat_ws(
+        ',', s.count, t.start, t.end,
+        s.min_lon, s.min_lat, s.max_lon, s.max_lat
+    )) as fingerprint
+from match_track t
+    inner join track_stats s on t.trip = s.trip and t.name = s.name
+        and t.device = s.device
 order by t.trip, t.start
 """
 
+SQL_LOAD_POS = """
+select st_x(location), st_y(location)
+from position
+where device = $1 and timestamp between $2 and $3
+order by timestamp
+"""
+
+# positions snapped to a grid in spherical Mercator projection; first
+# position of consecutive positions within the same grid cell is selected
+SQL_LOAD_POS_GRID = """
+with pos as (
+    select timestamp, st_x(location) as lon, st_y(location) as lat
+    from position
+    where device = $1 and timestamp between $2 and $3
+), cell as (
+    select timestamp, lon, lat,
+        floor(radians(lon) / $4) as x,
+        floor(ln(tan(pi() / 4 + radians(lat) / 2)) / $4) as y
+    from pos
+), prev as (
+    select timestamp, lon, lat, x, y,
+        lag(x) over w as prev_x, lag(y) over w as prev_y
+    from cell
+    window w as (order by timestamp)
+)
+select lon, lat
+from prev
+where prev_x is null or x <> prev_x or y <> prev_y
+order by timestamp
+"""
+
 @tx
-async def load_pos(dev, query):
-    data = await tx.conn.fetch(SQL_LOAD_POS, dev, query)
-    return data
+async def find_tracks(dev, query, mode='text'):
+    """
+    Find tracks matching a query.
+
+    Extent of each track is read from track statistics. Fingerprint of
+    track positions is calculated with number of positions, track period
+    and extent of the track. As positions are never updated, the
+    fingerprint changes when positions are added to a track.
+
+    :param dev: Device from which positions where obtained.
+    :param query: Trip and track name query.
+    :param mode: Search mode of the query, see `SEARCH_MODES`.
+    """
+    cond, value = match_cond(query, mode)
+    sql = SQL_FIND_TRACKS.format(SQL_MATCH_TRACK.format(cond))
+    with stats.timer('query'):
+        return (await tx.conn.fetch(sql, dev, value))
+
+@tx
+async def load_pos(dev, start, end, cell=None):
+    """
+    Load positions of a track using database cursor.
+
+    If grid cell size is specified, then positions are snapped to a grid
+    in spherical Mercator projection and only first position of
+    consecutive positions within a grid cell is loaded.
+
+    Array of longitude and latitude of positions is returned.
+
+    :param dev: Device from which positions where obtained.
+    :param start: Start of the track.
+    :param end: End of the track.
+    :param cell: Grid cell size in radians of spherical Mercator
+        projection.
+    """
+    with stats.timer('query') as t:
+        if cell is None:
+            cursor = await tx.conn.cursor(SQL_LOAD_POS, dev, start, end)
+        else:
+            cursor = await tx.conn.cursor(
+                SQL_LOAD_POS_GRID, dev, start, end, cell
+            )
+        chunks = []
+        data = await cursor.fetch(CURSOR_CHUNK)
+        while data:
+            chunks.append(np.array(data, dtype=np.float64))
+            data = await cursor.fetch(CURSOR_CHUNK)
+        result = np.concatenate(chunks) if chunks else np.empty((0, 2))
+        t.count = len(result)
+    return result
 
 # vim: sw=4:et:ai
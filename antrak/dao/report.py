@@ -18,27 +18,33 @@
 #
 
 import logging
+from antrak import stats
+from antrak.dao.search import match_cond, SQL_MATCH_TRACK
 from antrak.db import tx
 
 logger = logging.getLogger(__name__)
 
 SQL_TRACK_SUMMARY = """
-select t.trip, t.name, t.start, t.end,
-    extract('epoch' from t.end - t.start) as duration, -- duration in seconds
-    -- FIXME: what is best tolerance value for wgs84?
-    st_length(st_simplify(st_makeline(p.location), 0.000300), false) as distance, -- length in meters
-    max(speed) as max_speed
-from track t
-    inner join position p on t.device = p.device
-        and p.timestamp between t.start and t.end
-where p.device = $1 and t.trip || ' ' || t.name ~* $2
-group by t.trip, t.name, t.start, t.end
+with {}
+select t.trip, t.name, t.start, t.end, s.duration, s.distance, s.max_speed
+from match_track t
+    inner join track_stats s on t.trip = s.trip and t.name = s.name
+        and t.device = s.device
 order by t.trip, t.start
 """
 
 @tx
-async def track_summary(dev, query):
-    # TODO: support tsearch optionally
-    return (await tx.conn.fetch(SQL_TRACK_SUMMARY, dev, query))
+async def track_summary(dev, query, mode='text'):
+    """
+    Find summary of tracks matching a query.
+
+    :param dev: Device from which positions where obtained.
+    :param query: Trip and track name query.
+    :param mode: Search mode of the query, see `SEARCH_MODES`.
+    """
+    cond, value = match_cond(query, mode)
+    sql = SQL_TRACK_SUMMARY.format(SQL_MATCH_TRACK.format(cond))
+    with stats.timer('query'):
+        return (await tx.conn.fetch(sql, dev, value))
 
 # vim: sw=4:et:ai
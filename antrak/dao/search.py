@@ -0,0 +1,86 @@
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Search of tracks by trip and track name.
+
+Search modes are
+
+`text`
+    Full text search. Each word of a query has to be a prefix of a word
+    of trip or track name. The query is split into words by the same
+    text search parser as trip and track name. Uses full text search
+    index.
+`regex`
+    Case insensitive regular expression matched against trip and track
+    name separated with space. Uses trigram index.
+
+Query without words matches all tracks.
+
+Tracks matching a query are selected with `SQL_MATCH_TRACK` common table
+expression, i.e. to join positions of the matching tracks only.
+"""
+
+import re
+
+# track search modes
+SEARCH_MODES = ('text', 'regex')
+
+# common table expression selecting tracks of a device matching
+# a condition
+SQL_MATCH_TRACK = """match_track as (
+    select t.trip, t.name, t.device, t.start, t.end
+    from track t
+    where t.device = $1 {}
+)"""
+
+# full text search query is created with `plainto_tsquery` function and
+# `:*` is appended to each of its lexemes to match prefixes of words
+SQL_TSQUERY = r"""to_tsquery('simple', regexp_replace(
+    plainto_tsquery('simple', ${})::text, '''( |$)', ''':*\1', 'g'
+))"""
+
+SQL_MATCH = {
+    'text': 'and to_tsvector(\'simple\', t.trip || \' \' || t.name)'
+        ' @@ ' + SQL_TSQUERY,
+    'regex': 'and t.trip || \' \' || t.name ~* ${}',
+}
+
+# word of a query; underscore separates words as in PostgreSQL text
+# search parser
+RE_WORD = re.compile(r'[^\W_]+')
+
+def match_cond(query, mode='text', param=2):
+    """
+    Create SQL condition matching tracks with a query.
+
+    Tuple of SQL condition and its parameter value is returned.
+
+    :param query: Trip and track name query.
+    :param mode: Search mode, see `SEARCH_MODES`.
+    :param param: Index of query parameter of SQL query.
+    """
+    if mode not in SQL_MATCH:
+        raise ValueError('Unknown search mode: {}'.format(mode))
+    if mode == 'text' and not RE_WORD.search(query):
+        # empty regular expression matches all tracks
+        mode, query = 'regex', ''
+    return SQL_MATCH[mode].format(param), query
+
+# vim: sw=4:et:ai
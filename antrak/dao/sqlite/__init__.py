@@ -0,0 +1,176 @@
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Embedded SQLite storage.
+
+The schema of SQLite storage follows PostgreSQL database schema, but
+
+- timestamps are stored as number of microseconds since epoch in UTC
+- position location is stored in longitude, latitude and altitude
+  columns
+- SQLite stores NaN as null, so heading and speed columns are nullable
+- track search functions are implemented in Python, see `match_cond`
+
+The schema is created when storage is opened. Importing the package
+registers SQLite implementations of DAO functions, see
+`antrak.db.implements`.
+"""
+
+import re
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+from antrak.dao.search import RE_WORD
+
+SCHEMA = """
+pragma foreign_keys = on;
+
+create table if not exists position (
+    device text,
+    timestamp integer, -- microseconds since epoch in UTC
+    lon real not null,
+    lat real not null,
+    alt real,
+    heading real,
+    speed real,
+    step_distance real,
+    time_delta real,
+    vertical_speed real,
+    cum_distance real,
+    primary key (device, timestamp)
+) without rowid;
+
+create table if not exists track (
+    trip text,
+    name text,
+    device text,
+    start integer not null,
+    "end" integer not null,
+    primary key (trip, name, device),
+    foreign key (device, start) references position(device, timestamp),
+    foreign key (device, "end") references position(device, timestamp)
+);
+
+create table if not exists track_stats (
+    trip text,
+    name text,
+    device text,
+    distance real not null,
+    duration real not null,
+    max_speed real not null,
+    min_lon real not null,
+    min_lat real not null,
+    max_lon real not null,
+    max_lat real not null,
+    count integer not null,
+    primary key (trip, name, device),
+    foreign key (trip, name, device) references track on delete cascade
+);
+
+create table if not exists import_file (
+    device text,
+    path text,
+    inode integer not null,
+    size integer not null,
+    hash blob not null,
+    "offset" integer not null,
+    timestamp integer,
+    primary key (device, path)
+);
+"""
+
+SQL_MATCH = {
+    'text': 'and match_text(t.trip || \' \' || t.name, ?)',
+    'regex': 'and t.trip || \' \' || t.name regexp ?',
+}
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+ONE_US = timedelta(microseconds=1)
+
+def connect(path):
+    """
+    Open SQLite storage and create its schema.
+
+    :param path: Path of SQLite database file.
+    """
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.create_function('match_text', 2, match_text)
+    conn.create_function('regexp', 2, regexp)
+    conn.executescript(SCHEMA)
+
+    # register implementations of DAO functions
+    from antrak.dao.sqlite import export, manifest, map, report, track  # noqa
+    return conn
+
+def match_cond(query, mode='text'):
+    """
+    Create SQL condition matching tracks with a query.
+
+    Tuple of SQL condition and its parameter value is returned.
+
+    :param query: Trip and track name query.
+    :param mode: Search mode, see `SEARCH_MODES`.
+    """
+    if mode not in SQL_MATCH:
+        raise ValueError('Unknown search mode: {}'.format(mode))
+    if mode == 'text' and not RE_WORD.search(query):
+        # empty regular expression matches all tracks
+        mode, query = 'regex', ''
+    return SQL_MATCH[mode], query
+
+def match_text(text, query):
+    """
+    Check if each word of a query is a prefix of a word of a text.
+
+    Equivalent of full text search of `text` search mode, see
+    `antrak.dao.search.RE_WORD`.
+    """
+    words = RE_WORD.findall(text.lower())
+    terms = RE_WORD.findall(query.lower())
+    return all(any(w.startswith(t) for w in words) for t in terms)
+
+def regexp(pattern, text):
+    """
+    Match a text with case insensitive regular expression.
+    """
+    return re.search(pattern, text, re.IGNORECASE) is not None
+
+def to_us(ts):
+    """
+    Convert datetime object into number of microseconds since epoch.
+
+    Naive datetime object is in UTC. Null is returned for null value.
+    """
+    if ts is None:
+        return None
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return (ts - EPOCH) // ONE_US
+
+def from_us(value):
+    """
+    Convert number of microseconds since epoch into timezone aware
+    datetime object.
+
+    Null is returned for null value.
+    """
+    return None if value is None else EPOCH + value * ONE_US
+
+# vim: sw=4:et:ai
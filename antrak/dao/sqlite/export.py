@@ -0,0 +1,116 @@
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+SQLite storage implementation of `antrak.dao.export` module.
+
+Positions are fetched with database cursor in chunks.
+"""
+
+import logging
+import numpy as np
+
+from antrak import stats
+from antrak.dao import export as export_dao
+from antrak.dao.sqlite import match_cond, to_us
+from antrak.dao.sqlite.track import to_track
+from antrak.db import tx, implements
+
+logger = logging.getLogger(__name__)
+
+SQL_EXPORT_COLUMNS = """
+    p.timestamp, p.lon, p.lat, p.alt, p.heading, p.speed,
+    p.step_distance, p.time_delta, p.vertical_speed, p.cum_distance
+"""
+
+SQL_EXPORT_POS = """
+select {}
+from position p
+where p.device = ?
+    and p.timestamp >= coalesce(?, -9223372036854775808)
+    and p.timestamp <= coalesce(?, 9223372036854775807)
+order by p.timestamp
+""".format(SQL_EXPORT_COLUMNS)
+
+# tracks overlapping time period
+SQL_TRACK_PERIOD = """
+and t."end" >= coalesce(?, -9223372036854775808)
+and t.start <= coalesce(?, 9223372036854775807)
+"""
+
+SQL_EXPORT_TRACKS = """
+select trip, name, start, "end"
+from track t
+where t.device = ? {}
+order by start, trip, name
+"""
+
+SQL_EXPORT_TRACK_POS = """
+with track_id as (
+    select row_number() over (order by start, trip, name) - 1 as id,
+        device, start, "end"
+    from track t
+    where t.device = ? {{}}
+)
+select t.id, {}
+from track_id t
+    inner join position p on t.device = p.device
+        and p.timestamp between t.start and t."end"
+where p.timestamp >= coalesce(?, -9223372036854775808)
+    and p.timestamp <= coalesce(?, 9223372036854775807)
+order by t.id, p.timestamp
+""".format(SQL_EXPORT_COLUMNS)
+
+@implements(export_dao.find_tracks)
+async def find_tracks(dev, query, start=None, end=None, mode='text'):
+    cond, value = match_cond(query, mode)
+    sql = SQL_EXPORT_TRACKS.format(cond + SQL_TRACK_PERIOD)
+    data = tx.conn.execute(sql, (dev, value, to_us(start), to_us(end)))
+    return [to_track(r) for r in data]
+
+@implements(export_dao.export_pos)
+async def export_pos(
+        dev, write, start=None, end=None, query=None, mode='text'
+    ):
+    columns = export_dao.export_columns(query is not None)
+    start, end = to_us(start), to_us(end)
+    if query is None:
+        sql = SQL_EXPORT_POS
+        args = dev, start, end
+    else:
+        cond, value = match_cond(query, mode)
+        sql = SQL_EXPORT_TRACK_POS.format(cond + SQL_TRACK_PERIOD)
+        args = dev, value, start, end, start, end
+
+    # null values are converted into NaN
+    dtype = np.dtype([(n, f[1:]) for n, f in columns])
+    count = 0
+    with stats.timer('query') as t:
+        cursor = tx.conn.execute(sql, args)
+        data = cursor.fetchmany(export_dao.DECODE_SIZE // dtype.itemsize)
+        while data:
+            data = np.array(data, dtype=dtype)
+            write(data.astype(export_dao.CopyDecoder(columns).result_dtype))
+            count += len(data)
+            logger.debug('positions exported: {}'.format(count))
+            data = cursor.fetchmany(export_dao.DECODE_SIZE // dtype.itemsize)
+        t.count = count
+    return count
+
+# vim: sw=4:et:ai
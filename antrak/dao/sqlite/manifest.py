@@ -0,0 +1,74 @@
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+SQLite storage implementation of `antrak.dao.manifest` module.
+"""
+
+from antrak.dao import manifest as manifest_dao
+from antrak.dao.sqlite import to_us, from_us
+from antrak.db import tx, implements
+
+SQL_FIND = """
+select path, inode, size, hash, "offset", timestamp
+from import_file
+where device = ? and path in ({})
+"""
+
+SQL_SAVE = """
+insert into import_file (device, path, inode, size, hash, "offset", timestamp)
+values (?, ?, ?, ?, ?, ?, ?)
+on conflict (device, path) do update
+set inode = excluded.inode,
+    size = excluded.size,
+    hash = excluded.hash,
+    "offset" = excluded."offset",
+    timestamp = excluded.timestamp
+"""
+
+@implements(manifest_dao.find)
+async def find(dev, paths):
+    paths = list(paths)
+    sql = SQL_FIND.format(', '.join('?' * len(paths)))
+    data = tx.conn.execute(sql, (dev, *paths))
+    return {r[0]: to_entry(r) for r in data}
+
+@implements(manifest_dao.save)
+async def save(dev, entries):
+    data = (
+        (
+            dev, e['path'], e['inode'], e['size'], e['hash'], e['offset'],
+            to_us(e['timestamp'])
+        )
+        for e in entries
+    )
+    tx.conn.executemany(SQL_SAVE, data)
+
+def to_entry(row):
+    path, inode, size, hash, offset, timestamp = row
+    return {
+        'path': path,
+        'inode': inode,
+        'size': size,
+        'hash': hash,
+        'offset': offset,
+        'timestamp': from_us(timestamp),
+    }
+
+# vim: sw=4:et:ai
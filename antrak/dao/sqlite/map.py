@@ -0,0 +1,102 @@
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+SQLite storage implementation of `antrak.dao.map` module.
+
+Positions are snapped to a grid with NumPy instead of a database query.
+"""
+
+import hashlib
+import numpy as np
+
+from antrak import stats
+from antrak.dao import map as map_dao
+from antrak.dao.sqlite import match_cond, to_us, from_us
+from antrak.db import tx, implements
+
+SQL_FIND_TRACKS = """
+select t.trip, t.name, t.start, t."end",
+    s.min_lon, s.min_lat, s.max_lon, s.max_lat, s.count
+from track t
+    inner join track_stats s on t.trip = s.trip and t.name = s.name
+        and t.device = s.device
+where t.device = ? {}
+order by t.trip, t.start
+"""
+
+SQL_LOAD_POS = """
+select lon, lat
+from position
+where device = ? and timestamp between ? and ?
+order by timestamp
+"""
+
+@implements(map_dao.find_tracks)
+async def find_tracks(dev, query, mode='text'):
+    cond, value = match_cond(query, mode)
+    sql = SQL_FIND_TRACKS.format(cond)
+    with stats.timer('query'):
+        data = tx.conn.execute(sql, (dev, value)).fetchall()
+    return [to_track(r) for r in data]
+
+@implements(map_dao.load_pos)
+async def load_pos(dev, start, end, cell=None):
+    with stats.timer('query') as t:
+        cursor = tx.conn.execute(SQL_LOAD_POS, (dev, to_us(start), to_us(end)))
+        chunks = []
+        data = cursor.fetchmany(map_dao.CURSOR_CHUNK)
+        while data:
+            chunks.append(np.array(data, dtype=np.float64))
+            data = cursor.fetchmany(map_dao.CURSOR_CHUNK)
+        result = np.concatenate(chunks) if chunks else np.empty((0, 2))
+        if cell is not None:
+            result = snap_grid(result, cell)
+        t.count = len(result)
+    return result
+
+def snap_grid(positions, cell):
+    """
+    Select first position of consecutive positions within the same cell
+    of a grid in spherical Mercator projection.
+
+    :param positions: Array of longitude and latitude of positions.
+    :param cell: Grid cell size in radians of spherical Mercator
+        projection.
+    """
+    lon, lat = np.radians(positions.T)
+    x = np.floor(lon / cell)
+    y = np.floor(np.log(np.tan(np.pi / 4 + lat / 2)) / cell)
+    changed = (x[1:] != x[:-1]) | (y[1:] != y[:-1])
+    return positions[np.concatenate([[True], changed])[:len(positions)]]
+
+def to_track(row):
+    trip, name, start, end, *extent, count = row
+    start, end = from_us(start), from_us(end)
+    key = ','.join(str(v) for v in (count, start, end, *extent))
+    return {
+        'trip': trip,
+        'name': name,
+        'start': start,
+        'end': end,
+        'extent': extent,
+        'fingerprint': hashlib.md5(key.encode()).hexdigest(),
+    }
+
+# vim: sw=4:et:ai
@@ -0,0 +1,58 @@
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+SQLite storage implementation of `antrak.dao.report` module.
+"""
+
+from antrak import stats
+from antrak.dao import report as report_dao
+from antrak.dao.sqlite import match_cond, from_us
+from antrak.db import tx, implements
+
+SQL_TRACK_SUMMARY = """
+select t.trip, t.name, t.start, t."end", s.duration, s.distance, s.max_speed
+from track t
+    inner join track_stats s on t.trip = s.trip and t.name = s.name
+        and t.device = s.device
+where t.device = ? {}
+order by t.trip, t.start
+"""
+
+@implements(report_dao.track_summary)
+async def track_summary(dev, query, mode='text'):
+    cond, value = match_cond(query, mode)
+    sql = SQL_TRACK_SUMMARY.format(cond)
+    with stats.timer('query'):
+        data = tx.conn.execute(sql, (dev, value)).fetchall()
+    return [to_summary(r) for r in data]
+
+def to_summary(row):
+    trip, name, start, end, duration, distance, max_speed = row
+    return {
+        'trip': trip,
+        'name': name,
+        'start': from_us(start),
+        'end': from_us(end),
+        'duration': duration,
+        'distance': distance,
+        'max_speed': max_speed,
+    }
+
+# vim: sw=4:et:ai
@@ -0,0 +1,314 @@
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+SQLite storage implementation of `antrak.dao.track` module.
+"""
+
+import logging
+import numpy as np
+import time
+from itertools import repeat
+
+from antrak import stats
+from antrak.dao import track as track_dao
+from antrak.dao.sqlite import match_cond, to_us, from_us
+from antrak.db import tx, implements
+from antrak.position import PositionBatch, POS_DTYPE
+
+logger = logging.getLogger(__name__)
+
+SQL_SAVE_POS = """
+insert into position (
+    device, timestamp, lon, lat, alt, heading, speed,
+    step_distance, time_delta, vertical_speed, cum_distance
+)
+values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+on conflict do nothing
+"""
+
+SQL_PREV_POS = """
+select timestamp, lon, lat, alt, coalesce(cum_distance, 0)
+from position
+where device = ? and timestamp < ?
+order by timestamp desc
+limit 1
+"""
+
+SQL_LAST_POS_TIME = 'select max(timestamp) from position where device = ?'
+
+SQL_LOAD_POS_SINCE = """
+select timestamp, lon, lat, alt
+from position
+where device = ? and timestamp >= ?
+order by timestamp
+"""
+
+SQL_UPDATE_DERIVED = """
+update position
+set step_distance = ?, time_delta = ?, vertical_speed = ?, cum_distance = ?
+where device = ? and timestamp = ?
+"""
+
+SQL_FIND_TRACK_PERIOD = """
+select min(timestamp), max(timestamp)
+from position
+where device = ? and timestamp between ? and ?
+"""
+
+SQL_ADD_TRACK = """
+insert into track (trip, name, device, start, "end")
+values (?, ?, ?, ?, ?)
+"""
+
+SQL_ADD_TRACKS = SQL_ADD_TRACK + 'on conflict do nothing'
+
+SQL_LAST_TRACK_END = 'select max("end") from track where device = ?'
+
+SQL_LOAD_MOTION = """
+select timestamp, lon, lat, speed
+from position
+where device = ? and timestamp > coalesce(?, -9223372036854775808)
+order by timestamp
+"""
+
+SQL_UPDATE_STATS = """
+insert into track_stats (
+    trip, name, device, distance, duration, max_speed,
+    min_lon, min_lat, max_lon, max_lat, count
+)
+select t.trip, t.name, t.device,
+    coalesce(sum(p.step_distance) filter (where p.timestamp > t.start), 0),
+    (t."end" - t.start) / 1e6,
+    -- unknown speed is stored as null and ignored; zero if speed of all
+    -- positions is unknown
+    coalesce(max(p.speed), 0),
+    min(p.lon), min(p.lat), max(p.lon), max(p.lat),
+    count(*)
+from track t
+    inner join position p on t.device = p.device
+        and p.timestamp between t.start and t."end"
+where t.device = ? {}
+group by t.trip, t.name, t.device, t.start, t."end"
+on conflict (trip, name, device) do update
+set distance = excluded.distance,
+    duration = excluded.duration,
+    max_speed = excluded.max_speed,
+    min_lon = excluded.min_lon,
+    min_lat = excluded.min_lat,
+    max_lon = excluded.max_lon,
+    max_lat = excluded.max_lat,
+    count = excluded.count
+"""
+
+SQL_TRACK_LIST = """
+select trip, name, start, "end"
+from track t
+where t.device = ? {}
+order by start, trip, name
+"""
+
+@implements(track_dao.save_pos)
+async def save_pos(dev, batches):
+    logger.debug('saving positions')
+    conn = tx.conn
+
+    total = saved = 0
+    start = time.monotonic()
+    async for batch in batches:
+        if not len(batch):
+            continue
+
+        size = len(batch)
+        batch = track_dao.unique(batch)
+        timestamps = batch['timestamp'].astype(np.int64)
+        first = int(timestamps[0])
+        prev = conn.execute(SQL_PREV_POS, (dev, first)).fetchone()
+        last = conn.execute(SQL_LAST_POS_TIME, (dev,)).fetchone()[0]
+
+        with stats.timer('encode', len(batch)):
+            derived = batch.derive(to_prev(prev))
+            records = zip(
+                repeat(dev),
+                timestamps.tolist(),
+                batch['lon'].tolist(),
+                batch['lat'].tolist(),
+                batch['alt'].tolist(),
+                batch['heading'].tolist(),
+                batch['speed'].tolist(),
+                derived['step_distance'].tolist(),
+                derived['time_delta'].tolist(),
+                derived['vertical_speed'].tolist(),
+                derived['cum_distance'].tolist(),
+            )
+        with stats.timer('write', len(batch)):
+            changes = conn.total_changes
+            conn.executemany(SQL_SAVE_POS, records)
+            n = conn.total_changes - changes
+            if n and last is not None and last >= first:
+                logger.debug('repairing derived values since {}'.format(
+                    from_us(first)
+                ))
+                repair_derived(conn, dev, first)
+
+        stats.drop('write', 'duplicate', size - n)
+        total += size
+        saved += n
+        logger.debug('positions saved: {}'.format(saved))
+
+    elapsed = time.monotonic() - start
+    logger.info('saved {} positions in {:.1f}s ({:.0f} rows/s)'.format(
+        total, elapsed, total / elapsed if elapsed > 0 else 0
+    ))
+    if total > saved:
+        logger.info('ignored {} existing positions'.format(total - saved))
+    return saved
+
+def repair_derived(conn, dev, since):
+    """
+    Recalculate derived values of positions of a device since
+    a timestamp.
+
+    :param conn: SQLite connection.
+    :param dev: Device from which positions where obtained.
+    :param since: Number of microseconds since epoch.
+    """
+    prev = to_prev(conn.execute(SQL_PREV_POS, (dev, since)).fetchone())
+    cursor = conn.execute(SQL_LOAD_POS_SINCE, (dev, since))
+    data = cursor.fetchmany(track_dao.CURSOR_CHUNK)
+    while data:
+        batch = np.zeros(len(data), dtype=POS_DTYPE)
+        ts, batch['lon'], batch['lat'], batch['alt'] = zip(*data)
+        batch['timestamp'] = np.array(ts, dtype='datetime64[us]')
+        batch = PositionBatch(batch)
+
+        derived = batch.derive(prev)
+        conn.executemany(SQL_UPDATE_DERIVED, zip(
+            derived['step_distance'].tolist(),
+            derived['time_delta'].tolist(),
+            derived['vertical_speed'].tolist(),
+            derived['cum_distance'].tolist(),
+            repeat(dev),
+            ts,
+        ))
+
+        end = batch.data[-1]
+        prev = end['timestamp'], end['lon'], end['lat'], end['alt'], \
+            derived['cum_distance'][-1]
+        data = cursor.fetchmany(track_dao.CURSOR_CHUNK)
+
+def to_prev(row):
+    """
+    Convert row of previous position into tuple of timestamp, longitude,
+    latitude, altitude and cumulative distance.
+    """
+    if row is None:
+        return None
+    ts, lon, lat, alt, cum = row
+    alt = np.nan if alt is None else alt
+    return np.datetime64(ts, 'us'), lon, lat, alt, cum
+
+@implements(track_dao.find_period)
+async def find_period(dev, start, end):
+    row = tx.conn.execute(
+        SQL_FIND_TRACK_PERIOD, (dev, to_us(start), to_us(end))
+    ).fetchone()
+    return tuple(from_us(v) for v in row)
+
+@implements(track_dao.add)
+async def add(dev, trip, name, start, end):
+    logger.debug('saving trip {} - {} from {} to {} (device={})'.format(
+        trip, name, start, end, dev
+    ))
+    tx.conn.execute(
+        SQL_ADD_TRACK, (trip, name, dev, to_us(start), to_us(end))
+    )
+
+@implements(track_dao.add_tracks)
+async def add_tracks(dev, trip, tracks):
+    conn = tx.conn
+    added = set()
+    for name, start, end in tracks:
+        args = trip, name, dev, to_us(start), to_us(end)
+        if conn.execute(SQL_ADD_TRACKS, args).rowcount:
+            added.add(name)
+    return added
+
+@implements(track_dao.last_end)
+async def last_end(dev):
+    row = tx.conn.execute(SQL_LAST_TRACK_END, (dev,)).fetchone()
+    return from_us(row[0])
+
+@implements(track_dao.load_motion)
+async def load_motion(dev, since=None):
+    cursor = tx.conn.execute(SQL_LOAD_MOTION, (dev, to_us(since)))
+    data = cursor.fetchmany(track_dao.CURSOR_CHUNK)
+    while data:
+        yield np.array(data, dtype=track_dao.MOTION_DTYPE)
+        data = cursor.fetchmany(track_dao.CURSOR_CHUNK)
+
+@implements(track_dao.update_stats)
+async def update_stats(
+        dev, trip=None, name=None, start=None, end=None, query=None,
+        mode='text', missing=False
+    ):
+    if trip is not None:
+        cond = 'and t.trip = ? and t.name = ?'
+        args = dev, trip, name
+    elif start is not None:
+        cond = 'and t.start <= ? and t."end" >= ?'
+        args = dev, to_us(end), to_us(start)
+    else:
+        cond, value = match_cond(query, mode)
+        args = dev, value
+
+    if missing:
+        cond += """
+and not exists (
+    select 1 from track_stats s
+    where s.trip = t.trip and s.name = t.name and s.device = t.device
+)"""
+
+    sql = SQL_UPDATE_STATS.format(cond)
+    with stats.timer('query'):
+        n = tx.conn.execute(sql, args).rowcount
+    logger.debug('track statistics updated: {}'.format(n))
+
+@implements(track_dao.track_list)
+async def track_list(dev, query='', mode='text'):
+    if query:
+        cond, value = match_cond(query, mode)
+        args = dev, value
+    else:
+        cond = ''
+        args = (dev,)
+
+    data = tx.conn.execute(SQL_TRACK_LIST.format(cond), args)
+    return [to_track(r) for r in data]
+
+def to_track(row):
+    trip, name, start, end = row
+    return {
+        'trip': trip,
+        'name': name,
+        'start': from_us(start),
+        'end': from_us(end),
+    }
+
+# vim: sw=4:et:ai
@@ -18,13 +18,106 @@
 #
 
 import logging
+import numpy as np
+import time
+from datetime import timezone
+from itertools import repeat
+
+from antrak import stats
+from antrak.dao.search import match_cond, SQL_MATCH_TRACK
 from antrak.db import tx
 
 logger = logging.getLogger(__name__)
 
+POS_COLUMNS = (
+    'device', 'timestamp', 'location', 'heading', 'speed',
+    'step_distance', 'time_delta', 'vertical_speed', 'cum_distance',
+)
+
+SQL_CREATE_POS_IMPORT = """
+create temporary table if not exists position_import
+(like position) on commit drop
+"""
+
 SQL_SAVE_POS = """
-insert into position (device, timestamp, location, heading, speed)
-values ($1, $2, $3, $4, $5)
+insert into position (
+    device, timestamp, location, heading, speed,
+    step_distance, time_delta, vertical_speed, cum_distance
+)
+select device, timestamp, location, heading, speed,
+    step_distance, time_delta, vertical_speed, cum_distance
+from position_import
+on conflict do nothing
+"""
+
+SQL_CLEAR_POS_IMPORT = 'truncate position_import'
+
+# check if position table is partitioned
+SQL_IS_PARTITIONED = """
+select relkind = 'p'
+from pg_class
+where oid = 'position'::regclass
+"""
+
+SQL_ADD_PARTITIONS = """
+select position_add_partitions(min(timestamp), max(timestamp))
+from position_import
+"""
+
+# last position of a device before a timestamp, used to calculate derived
+# values of a batch of positions
+SQL_PREV_POS = """
+select timestamp, st_x(location), st_y(location), st_z(location),
+    coalesce(cum_distance, 0)
+from position
+where device = $1 and timestamp < $2
+order by timestamp desc
+limit 1
+"""
+
+SQL_LAST_POS_TIME = 'select max(timestamp) from position where device = $1'
+
+# recalculate derived values of positions of a device since a timestamp,
+# i.e. when positions are inserted before already saved positions
+SQL_REPAIR_DERIVED = """
+with anchor as (
+    select timestamp, location, coalesce(cum_distance, 0) as cum_distance
+    from position
+    where device = $1 and timestamp < $2
+    order by timestamp desc
+    limit 1
+),
+pos as (
+    select timestamp, location from anchor
+    union all
+    select timestamp, location from position
+    where device = $1 and timestamp >= $2
+),
+step as (
+    select timestamp,
+        coalesce(position_distance(lag(location) over w, location), 0)
+            as step_distance,
+        coalesce(extract(epoch from timestamp - lag(timestamp) over w), 0)
+            as time_delta,
+        st_z(location) - st_z(lag(location) over w) as dz
+    from pos
+    window w as (order by timestamp)
+),
+derived as (
+    select timestamp, step_distance, time_delta,
+        case when time_delta > 0 then dz / time_delta else 0 end
+            as vertical_speed,
+        coalesce((select cum_distance from anchor), 0)
+            + sum(step_distance) over (order by timestamp) as cum_distance
+    from step
+)
+update position p
+set step_distance = d.step_distance,
+    time_delta = d.time_delta,
+    vertical_speed = d.vertical_speed,
+    cum_distance = d.cum_distance
+from derived d
+where p.device = $1 and p.timestamp = d.timestamp and p.timestamp >= $2
 """
 
 SQL_FIND_TRACK_PERIOD = """
@@ -38,33 +131,186 @@ insert into track (trip, name, device, start, "end")
 values ($1, $2, $3, $4, $5)
 """
 
+SQL_ADD_TRACKS = """
+insert into track (trip, name, device, start, "end")
+select $1, t.name, $2, t.start, t.end
+from unnest($3::text[], $4::timestamptz[], $5::timestamptz[])
+    as t(name, start, "end")
+on conflict do nothing
+returning name
+"""
+
+SQL_LAST_TRACK_END = 'select max("end") from track where device = $1'
+
+# timestamp of a position is loaded as number of microseconds since epoch
+SQL_LOAD_MOTION = """
+select (extract(epoch from timestamp) * 1000000)::bigint,
+    st_x(location), st_y(location), speed
+from position
+where device = $1 and timestamp > coalesce($2, '-infinity')
+order by timestamp
+"""
+
+MOTION_DTYPE = np.dtype([
+    ('timestamp', 'i8'),
+    ('lon', 'f8'),
+    ('lat', 'f8'),
+    ('speed', 'f8'),
+])
+
+# number of positions fetched at once from a database cursor
+CURSOR_CHUNK = 10000
+
+SQL_UPDATE_STATS = """
+with {}
+insert into track_stats (
+    trip, name, device, distance, duration, max_speed,
+    min_lon, min_lat, max_lon, max_lat, count
+)
+select t.trip, t.name, t.device,
+    -- length in meters; step distance of first position leads outside
+    -- of the track
+    coalesce(sum(p.step_distance) filter (where p.timestamp > t.start), 0)
+        as distance,
+    extract('epoch' from t.end - t.start) as duration, -- duration in seconds
+    -- unknown (NaN) speed is ignored; zero if speed of all positions is
+    -- unknown, as in SQLite storage
+    coalesce(max(p.speed) filter (where p.speed <> 'NaN'), 0) as max_speed,
+    min(st_x(p.location)), min(st_y(p.location)),
+    max(st_x(p.location)), max(st_y(p.location)),
+    count(*)
+from match_track t
+    inner join position p on t.device = p.device
+        and p.timestamp between t.start and t.end
+group by t.trip, t.name, t.device, t.start, t.end
+on conflict (trip, name, device) do update
+set distance = excluded.distance,
+    duration = excluded.duration,
+    max_speed = excluded.max_speed,
+    min_lon = excluded.min_lon,
+    min_lat = excluded.min_lat,
+    max_lon = excluded.max_lon,
+    max_lat = excluded.max_lat,
+    count = excluded.count
+"""
+
 SQL_TRACK_LIST = """
+with {}
 select trip, name, start, "end"
-from track
-where device = $1 {}
+from match_track
 order by start, trip, name
 """
 
 @tx
-async def save_pos(dev, data):
+async def save_pos(dev, batches):
     """
     Save positions to a database.
 
+    Each batch of positions is sent to a database with binary `COPY`
+    command, so the memory usage does not depend on the number of
+    positions.
+
+    The positions are copied into temporary table first, then inserted
+    into position table. Positions, which already exist in the database,
+    are ignored.
+
+    If position table is partitioned, then missing partitions are created
+    before the positions are inserted.
+
+    Step distance, time delta, vertical speed and cumulative distance of
+    positions are calculated from consecutive positions of the device and
+    saved with the positions. If positions are inserted before already
+    saved positions of the device, then the values of the following
+    positions are recalculated.
+
+    Number of saved positions is returned.
+
     :param dev: Device from which positions where obtained.
-    :param data: Collection of positions to be saved in a database.
+    :param batches: Asynchronous iterable of batches of positions to be
+        saved in a database.
     """
-    extract = lambda p: (
-        dev,
-        p.properties['timestamp'],
-        p,
-        p.properties['heading'],
-        p.properties['speed'],
-    )
-    data = (extract(p) for p in data)
-
     logger.debug('saving positions')
-    await tx.conn.executemany(SQL_SAVE_POS, data)
-    logger.debug('positions saved')
+    conn = tx.conn
+    await conn.execute(SQL_CREATE_POS_IMPORT)
+    await conn.execute(SQL_CLEAR_POS_IMPORT)
+    partitioned = await conn.fetchval(SQL_IS_PARTITIONED)
+
+    total = saved = 0
+    start = time.monotonic()
+    async for batch in batches:
+        if not len(batch):
+            continue
+
+        size = len(batch)
+        batch = unique(batch)
+        timestamps = batch.timestamps()
+        prev = await conn.fetchrow(SQL_PREV_POS, dev, timestamps[0])
+        last = await conn.fetchval(SQL_LAST_POS_TIME, dev)
+
+        with stats.timer('encode', len(batch)):
+            derived = batch.derive(to_prev(prev))
+            records = zip(
+                repeat(dev),
+                timestamps,
+                batch.wkb(),
+                batch['heading'].tolist(),
+                batch['speed'].tolist(),
+                derived['step_distance'].tolist(),
+                derived['time_delta'].tolist(),
+                derived['vertical_speed'].tolist(),
+                derived['cum_distance'].tolist(),
+            )
+        with stats.timer('write', len(batch)):
+            await conn.copy_records_to_table(
+                'position_import', records=records, columns=POS_COLUMNS
+            )
+            if partitioned:
+                await conn.execute(SQL_ADD_PARTITIONS)
+            status = await conn.execute(SQL_SAVE_POS)
+            await conn.execute(SQL_CLEAR_POS_IMPORT)
+
+            n = int(status.split()[-1])
+            if n and last is not None and last >= timestamps[0]:
+                logger.debug('repairing derived values since {}'.format(
+                    timestamps[0]
+                ))
+                await conn.execute(SQL_REPAIR_DERIVED, dev, timestamps[0])
+
+        stats.drop('write', 'duplicate', size - n)
+        total += size
+        saved += n
+        logger.debug('positions saved: {}'.format(saved))
+
+    elapsed = time.monotonic() - start
+    logger.info('saved {} positions in {:.1f}s ({:.0f} rows/s)'.format(
+        total, elapsed, total / elapsed if elapsed > 0 else 0
+    ))
+    if total > saved:
+        logger.info('ignored {} existing positions'.format(total - saved))
+    return saved
+
+def unique(batch):
+    """
+    Sort batch of positions by timestamp and remove positions with
+    duplicate timestamps.
+    """
+    ts = batch['timestamp']
+    if len(ts) > 1 and not (ts[1:] > ts[:-1]).all():
+        batch = batch[np.argsort(ts, kind='mergesort')]
+        ts = batch['timestamp']
+        batch = batch[np.concatenate([[True], ts[1:] != ts[:-1]])]
+    return batch
+
+def to_prev(row):
+    """
+    Convert database row of previous position into tuple of timestamp,
+    longitude, latitude, altitude and cumulative distance.
+    """
+    if row is None:
+        return None
+    ts, lon, lat, alt, cum = row
+    ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return np.datetime64(ts, 'us'), lon, lat, alt, cum
 
 @tx
 async def find_period(dev, start, end):
@@ -79,15 +325,105 @@ async def add(dev, trip, name, start, end):
     await tx.conn.execute(SQL_ADD_TRACK, trip, name, dev, start, end)
 
 @tx
-async def track_list(dev, query=''):
+async def add_tracks(dev, trip, tracks):
+    """
+    Add multiple tracks of a trip.
+
+    Existing tracks are ignored. Set of names of added tracks is
+    returned.
+
+    :param dev: Device from which positions where obtained.
+    :param trip: Trip name.
+    :param tracks: Collection of tuples of track name, start and end.
+    """
+    names, starts, ends = zip(*tracks) if tracks else ((), (), ())
+    rows = await tx.conn.fetch(
+        SQL_ADD_TRACKS, trip, dev, list(names), list(starts), list(ends)
+    )
+    return {r['name'] for r in rows}
+
+@tx
+async def last_end(dev):
+    """
+    Find end of the last track of a device.
+
+    :param dev: Device from which positions where obtained.
+    """
+    return (await tx.conn.fetchval(SQL_LAST_TRACK_END, dev))
+
+@tx.dispatch
+async def load_motion(dev, since=None):
+    """
+    Load timestamp, location and speed of positions in chunks using
+    database cursor.
+
+    Positions are ordered by timestamp. NumPy structured array of
+    `MOTION_DTYPE` type is returned for each chunk. Timestamp is number
+    of microseconds since epoch.
+
+    Has to be called within a transaction.
+
+    :param dev: Device from which positions where obtained.
+    :param since: Load positions newer than this timestamp if specified.
+    """
+    cursor = await tx.conn.cursor(SQL_LOAD_MOTION, dev, since)
+    data = await cursor.fetch(CURSOR_CHUNK)
+    while data:
+        yield np.array([tuple(r) for r in data], dtype=MOTION_DTYPE)
+        data = await cursor.fetch(CURSOR_CHUNK)
+
+@tx
+async def update_stats(
+        dev, trip=None, name=None, start=None, end=None, query=None,
+        mode='text', missing=False
+    ):
+    """
+    Calculate and save statistics of tracks.
+
+    Statistics of a track identified by trip and name, of tracks
+    overlapping time period or of tracks matching a query are updated.
+
+    :param dev: Device from which positions where obtained.
+    :param trip: Trip name.
+    :param name: Track name.
+    :param start: Start of time period.
+    :param end: End of time period.
+    :param query: Trip and track name query.
+    :param mode: Search mode of the query, see `SEARCH_MODES`.
+    :param missing: Update statistics only if they do not exist.
+    """
+    if trip is not None:
+        cond = 'and t.trip = $2 and t.name = $3'
+        args = dev, trip, name
+    elif start is not None:
+        cond = 'and t.start <= $3 and t.end >= $2'
+        args = dev, start, end
+    else:
+        cond, value = match_cond(query, mode)
+        args = dev, value
+
+    if missing:
+        cond += """
+and not exists (
+    select 1 from track_stats s
+    where s.trip = t.trip and s.name = t.name and s.device = t.device
+)"""
+
+    sql = SQL_UPDATE_STATS.format(SQL_MATCH_TRACK.format(cond))
+    with stats.timer('query'):
+        status = await tx.conn.execute(sql, *args)
+    logger.debug('track statistics updated: {}'.format(status.split()[-1]))
+
+@tx
+async def track_list(dev, query='', mode='text'):
     if query:
-        cond = 'and trip || \' \' || name ~* $2'
-        args = dev, query
+        cond, value = match_cond(query, mode)
+        args = dev, value
     else:
         cond = ''
         args = (dev,)
 
-    sql = SQL_TRACK_LIST.format(cond)
+    sql = SQL_TRACK_LIST.format(SQL_MATCH_TRACK.format(cond))
     return (await tx.conn.fetch(sql, *args))
 
 # vim: sw=4:et:ai
@@ -19,16 +19,37 @@
 
 """
 Database functions.
+
+Data is stored in PostgreSQL database with PostGIS extension. Embedded
+SQLite storage is used when database connection string starts with
+`sqlite:` prefix, i.e. `sqlite:antrak.db`. The functions of DAO modules
+are implemented for SQLite storage in `antrak.dao.sqlite` package.
 """
 
+import asyncio
 import asyncpg
+import contextvars
+import functools
 import logging
+from contextlib import contextmanager
 
 from shapely.wkb import loads as from_wkb
 from antrak.util import to_wkb
 
 logger = logging.getLogger(__name__)
 
+# default database connection string
+DSN = 'postgres:antrak'
+
+# default maximum number of database connections
+POOL_SIZE = 4
+
+# prefix of connection string of SQLite storage
+SQLITE_PREFIX = 'sqlite:'
+
+# implementations of DAO functions for SQLite storage
+SQLITE_IMPL = {}
+
 class TxManager:
     """
     Decorative database connection and transaction manager.
@@ -37,51 +58,190 @@ class TxManager:
     called one within each other and they will share the same database
     connection and transaction.
 
-    :var conn: Database connection.
+    Connections are obtained from a connection pool. Decorated functions
+    executed by concurrent tasks, i.e. with `asyncio.gather`, use their
+    own connections and transactions.
+
+    SQLite storage has single connection and transactions of concurrent
+    tasks are executed one after another. Decorated function is replaced
+    with its SQLite storage implementation if it exists, see `implements`.
+
     :var dsn: Database connection string.
-    :var _nested: Counter to track nested calls. Close connection when
-        equals to zero.
+    :var pool_size: Maximum number of connections in the pool.
+    :var pool: Database connection pool or SQLite connection, created on
+        first use.
+    :var _context: Context variable with task and its database connection.
+    :var _lock: Lock of SQLite connection.
     """
-    def __init__(self):
-        self.conn = None
+    def __init__(self, dsn=DSN, pool_size=POOL_SIZE):
+        self.dsn = dsn
+        self.pool_size = pool_size
+        self.pool = None
+        self._context = contextvars.ContextVar('antrak_tx', default=None)
+        self._lock = None
 
-        # TODO: remove hardcoding
-        self.dsn = 'postgres:antrak'
-        self._nested = 0
+    @property
+    def sqlite(self):
+        """
+        Check if SQLite storage is used.
+        """
+        return self.dsn.startswith(SQLITE_PREFIX)
+
+    @property
+    def conn(self):
+        """
+        Database connection of current task.
+        """
+        ctx = self._context.get()
+        return ctx[1] if ctx else None
 
     def __call__(self, f):
         """
         Decorator to connect to a database and execute decorated function
         within database transaction.
         """
+        @functools.wraps(f)
         async def execute(*args, **kw):
+            if self.sqlite:
+                return (await self._execute_sqlite(f, *args, **kw))
+
+            task = asyncio.current_task()
+            ctx = self._context.get()
+
+            # context variables are inherited by child tasks, so check
+            # if connection belongs to current task
+            if ctx and ctx[0] is task:
+                logger.debug('reusing db connection')
+                async with ctx[1].transaction():
+                    return (await f(*args, **kw))
+
+            pool = await self.get_pool()
+            async with pool.acquire() as conn:
+                logger.debug('acquired db connection')
+                token = self._context.set((task, conn))
+                try:
+                    async with conn.transaction():
+                        return (await f(*args, **kw))
+                finally:
+                    self._context.reset(token)
+                    logger.debug('releasing db connection')
+        return execute
+
+    def dispatch(self, f):
+        """
+        Decorator to call SQLite storage implementation of a function,
+        which is executed within transaction of its caller, i.e.
+        asynchronous generator.
+        """
+        @functools.wraps(f)
+        def execute(*args, **kw):
+            return self.impl(f)(*args, **kw)
+        return execute
+
+    def impl(self, f):
+        """
+        Get implementation of a function for used storage.
+        """
+        if self.sqlite:
+            self.get_sqlite()
+            return SQLITE_IMPL.get(f, f)
+        return f
+
+    async def _execute_sqlite(self, f, *args, **kw):
+        f = self.impl(f)
+        task = asyncio.current_task()
+        ctx = self._context.get()
+        if ctx and ctx[0] is task:
+            with savepoint(ctx[1]):
+                return (await f(*args, **kw))
+
+        conn = self.get_sqlite()
+        async with self._lock:
+            token = self._context.set((task, conn))
             try:
-                self._nested += 1
-                if self.conn is None:
-                    logger.debug('create db connection')
-                    self.conn = await asyncpg.connect(self.dsn)
-                    await self.conn.set_type_codec(
-                        'geometry', encoder=to_wkb, decoder=from_wkb,
-                        format='binary'
-                    )
-                else:
-                    logger.debug('reusing db connection')
-
-                async with self.conn.transaction():
+                with savepoint(conn):
                     return (await f(*args, **kw))
             finally:
-                self._nested -= 1
-                if self.conn and self._nested == 0:
-                    logger.debug('closing connection')
-                    await self.conn.close()
-                    self.conn = None
-
-                assert self._nested >= 0 and (
-                    self.conn and self._nested > 0
-                    or not self.conn and self._nested == 0
-                ), (self.conn, self._nested)
-        return execute
+                self._context.reset(token)
+
+    def get_sqlite(self):
+        """
+        Get SQLite connection.
+
+        The connection is created and SQLite storage is initialized on
+        first call.
+        """
+        if self.pool is None:
+            from antrak.dao import sqlite
+
+            path = self.dsn[len(SQLITE_PREFIX):]
+            logger.debug('open sqlite storage {}'.format(path))
+            self.pool = sqlite.connect(path)
+            self._lock = asyncio.Lock()
+        return self.pool
+
+    async def get_pool(self):
+        """
+        Get database connection pool.
+
+        The pool is created on first call.
+        """
+        if self.pool is None:
+            logger.debug('create db connection pool')
+            self.pool = await asyncpg.create_pool(
+                self.dsn, min_size=1, max_size=self.pool_size,
+                init=init_conn
+            )
+        return self.pool
+
+    async def close(self):
+        """
+        Close database connection pool.
+        """
+        if self.pool is not None and self.sqlite:
+            logger.debug('closing sqlite storage')
+            self.pool.close()
+            self.pool = None
+        elif self.pool is not None:
+            logger.debug('closing db connection pool')
+            await self.pool.close()
+            self.pool = None
+
+async def init_conn(conn):
+    """
+    Initialize new database connection.
+    """
+    await conn.set_type_codec(
+        'geometry', encoder=to_wkb, decoder=from_wkb, format='binary'
+    )
+
+def implements(f):
+    """
+    Decorator to register SQLite storage implementation of DAO function.
+
+    :param f: DAO function.
+    """
+    def register(impl):
+        SQLITE_IMPL[getattr(f, '__wrapped__', f)] = impl
+        return impl
+    return register
+
+@contextmanager
+def savepoint(conn):
+    """
+    Execute code within SQLite savepoint, which starts transaction if
+    there is no transaction.
+    """
+    conn.execute('savepoint tx')
+    try:
+        yield
+    except BaseException:
+        conn.execute('rollback to tx')
+        conn.execute('release tx')
+        raise
+    else:
+        conn.execute('release tx')
 
-tx = TxManager()  # TODO: use thread local context
+tx = TxManager()
 
 # vim: sw=4:et:ai
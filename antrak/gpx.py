@@ -19,37 +19,165 @@
 
 """
 GPX format parsing functions.
+
+GPX file is parsed in streaming mode, so the memory usage does not depend
+on size of the file.
 """
 
 import logging
+import numpy as np
+from datetime import datetime, timezone
 from dateutil.parser import parse as date_parse
 from lxml import etree as et
-from shapely.geometry import Point
+from toolz.itertoolz import partition_all
+
+from antrak.position import PositionBatch, distance
 
 logger = logging.getLogger(__name__)
 
 NS = {
     'gpx': 'http://www.topografix.com/GPX/1/1'
 }
+TAG_TRKPT = '{{{}}}trkpt'.format(NS['gpx'])
+TAG_TIME = '{{{}}}time'.format(NS['gpx'])
+TAG_ELE = '{{{}}}ele'.format(NS['gpx'])
+
+# maximum number of positions in a batch
+BATCH_SIZE = 10000
+
+NAN = float('nan')
+
+def parse_points(f, batch_size=BATCH_SIZE):
+    """
+    Read batches of GPS positions from GPX file.
+
+    GPX file does not provide heading, speed and dilution of precision
+    values. Heading and speed are calculated using previous position,
+    dilution of precision values are set to NaN. Altitude is set to NaN
+    if track point has no elevation.
+
+    Track points without time are skipped.
+
+    :param f: GPX file name or file-like object.
+    :param batch_size: Maximum number of positions in a batch.
+    """
+    data = (to_record(item) for item in iter_points(f))
+    data = (r for r in data if r is not None)
+    batches = (
+        PositionBatch.from_records(records)
+        for records in partition_all(batch_size, data)
+    )
+    return add_motion(batches)
+
+def iter_points(f):
+    """
+    Iterate over track points of GPX file.
+
+    A track point element is cleared after it is processed.
+    """
+    items = et.iterparse(f, events=('end',), tag=TAG_TRKPT)
+    for _, item in items:
+        yield item
+
+        # release processed elements
+        item.clear()
+        while item.getprevious() is not None:
+            del item.getparent()[0]
+
+def to_record(item):
+    """
+    Convert GPX track point into position record.
+
+    If track point has no time, then `None` is returned.
+    """
+    ts = elevation = None
+    for child in item:
+        if child.tag == TAG_TIME:
+            ts = child.text
+        elif child.tag == TAG_ELE:
+            elevation = child.text
+
+    if not ts:
+        logger.warning('track point without time at line {}'.format(
+            item.sourceline
+        ))
+        return None
+
+    lat = float(item.get('lat'))
+    lon = float(item.get('lon'))
+    ts = parse_time(ts.strip())
+    elevation = float(elevation) if elevation else NAN
+
+    return (ts, lon, lat, elevation, NAN, NAN, True, NAN, NAN, NAN)
+
+def parse_time(value):
+    """
+    Parse ISO-8601 timestamp.
+
+    Naive datetime object in UTC is returned. Timestamp with time zone
+    offset is converted to UTC, UTC is assumed for timestamp without time
+    zone.
+
+    The `YYYY-MM-DDTHH:MM:SS[.ffffff][Z]` format is parsed directly, other
+    formats are parsed with `dateutil` module.
+    """
+    n = len(value)
+    if n >= 19 and value[4] == '-' and value[7] == '-' and value[10] == 'T' \
+            and value[13] == ':' and value[16] == ':' \
+            and value[:4].isdigit() and value[5:7].isdigit() \
+            and value[8:10].isdigit() and value[11:13].isdigit() \
+            and value[14:16].isdigit() and value[17:19].isdigit():
+
+        k = n - 1 if value[-1] == 'Z' else n
+        fraction = value[20:k]
+        if k == 19 or value[19] == '.' and fraction.isdigit():
+            return datetime(
+                int(value[:4]), int(value[5:7]), int(value[8:10]),
+                int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                int(fraction[:6].ljust(6, '0')) if fraction else 0
+            )
+
+    ts = date_parse(value)
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+def add_motion(batches):
+    """
+    Calculate heading and speed of positions using previous position.
+
+    The heading and speed of first position are set to zero. Speed is
+    also set to zero if time difference between positions is zero.
+    """
+    last = None
+    for batch in batches:
+        data = batch.data
+        lon = data['lon']
+        lat = data['lat']
+        ts = data['timestamp']
+
+        lon1 = np.roll(lon, 1)
+        lat1 = np.roll(lat, 1)
+        ts1 = np.roll(ts, 1)
+        if last is None:
+            lon1[0], lat1[0], ts1[0] = lon[0], lat[0], ts[0]
+        else:
+            lon1[0], lat1[0], ts1[0] = last
+        last = lon[-1], lat[-1], ts[-1]
+
+        dist = distance(lon1, lat1, lon, lat)
+        td = (ts - ts1) / np.timedelta64(1, 's')
+
+        lon, lat, lon1, lat1 = map(np.radians, (lon, lat, lon1, lat1))
+        dlon = lon - lon1
+        heading = np.arctan2(
+            np.sin(dlon) * np.cos(lat),
+            np.cos(lat1) * np.sin(lat) - np.sin(lat1) * np.cos(lat) * np.cos(dlon)
+        )
+        data['heading'] = np.degrees(heading) % 360
+        with np.errstate(divide='ignore', invalid='ignore'):
+            data['speed'] = np.where(td > 0, dist / td * 3.6, 0)
 
-def parse_points(f):
-    doc = et.parse(f)
-    items = doc.iterfind('//gpx:trkpt', namespaces=NS)
-    for item in items:
-        lat = float(item.get('lat'))
-        lon = float(item.get('lon'))
-
-        ts = item.xpath('gpx:time/text()', namespaces=NS)
-        ts = date_parse(ts[0], ignoretz=True)  # UTC assumed
-
-        elevation = item.xpath('gpx:ele/text()', namespaces=NS)
-        elevation = float(elevation[0])
-
-        p = Point(lon, lat, elevation)
-        p.properties = {}
-        p.properties['timestamp'] = ts
-        #p.properties['heading'] = heading
-        #p.properties['speed'] = speed
-        yield p
+        yield batch
 
 # vim: sw=4:et:ai
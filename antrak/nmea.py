@@ -19,19 +19,374 @@
 
 """
 Parsing of GPS positions stored in NMEA format.
+
+The module implements two parsers
+
+`parse_pos`
+    Fast parser of `GPRMC`, `GPGGA`, `GPVTG` and `GPGSA` sentences, which
+    reads buffers of bytes.
+`parse_pos_pynmea2`
+    Parser based on pynmea2 library, which is slower, but supports all
+    NMEA sentences known to the library.
+
+Both parsers produce batches of positions, see
+`antrak.position.PositionBatch` class, and group NMEA sentences into
+epochs - an epoch starts with `RMC` sentence and a position is created
+only if an epoch has all four sentences mentioned above.
 """
 
 import itertools
 import logging
+import numpy as np
 import pynmea2
-from datetime import timezone
-from shapely.geometry import Point
+from datetime import datetime
+from toolz.itertoolz import partition_all
+
+from antrak import stats
+from antrak.position import PositionBatch
 
 logger = logging.getLogger(__name__)
 
-def parse_pos(f):
+# size of a buffer read from a file by the fast parser
+BUFFER_SIZE = 1024 * 1024
+
+# maximum number of positions in a batch produced by the fast parser
+BATCH_SIZE = 10000
+
+# value of empty numeric field of NMEA sentence
+NAN = b'nan'
+
+# NMEA sentences required to create a position
+SENTENCES = frozenset((b'GPRMC', b'GPGGA', b'GPVTG', b'GPGSA'))
+
+# values of hexadecimal digits; invalid digits are mapped to large
+# negative number, so checksum calculated from them is always invalid
+HEX = np.full(256, -256, dtype=np.int32)
+HEX[list(b'0123456789')] = range(10)
+HEX[list(b'ABCDEF')] = range(10, 16)
+HEX[list(b'abcdef')] = range(10, 16)
+
+def parse_pos(f, batch_size=BATCH_SIZE, parser=None):
+    """
+    Read batches of GPS positions from binary file-like object serving
+    NMEA sentences.
+
+    Sentences with invalid checksum, incomplete epochs and epochs with
+    invalid data are skipped.
+
+    Offset of a file, from which the reading can be resumed, is stored in
+    `offset` attribute of the parser when the file is read. Offsets of
+    epochs of positions of the last returned batch are stored in
+    `batch_offsets` attribute of the parser.
+
+    :param f: Binary file-like object.
+    :param batch_size: Maximum number of records in a batch.
+    :param parser: Optional NMEA parser.
+    """
+    if parser is None:
+        parser = Parser(f.tell())
+
+    items = read_sentences(f)
+    while True:
+        with stats.timer('parse'):
+            item = next(items, None)
+        if item is None:
+            break
+        with stats.timer('group'):
+            parser.feed(*item)
+        if len(parser.records) >= batch_size:
+            yield from _batches(parser, batch_size)
+
+    with stats.timer('group'):
+        parser.flush()
+    yield from _batches(parser, batch_size)
+
+    if parser.skipped:
+        logger.warning('skipped {} incomplete or invalid epochs'.format(
+            parser.skipped
+        ))
+        stats.drop('parse', 'invalid_epoch', parser.skipped)
+
+async def parse_stream(reader, buffer_size=BUFFER_SIZE):
+    """
+    Read batches of GPS positions from asyncio stream reader serving NMEA
+    sentences.
+
+    A batch is returned as soon as new positions are available. Position
+    is available when first sentence of next epoch is received.
+
+    :param reader: Asyncio stream reader.
+    :param buffer_size: Maximum number of bytes read at once.
     """
-    Read GPS positions from file-like object serving NMEA sentences. 
+    parser = Parser()
+    tail = b''
+    offset = 0
+    data = await reader.read(buffer_size)
+    while data:
+        buff = tail + data
+        k = buff.rfind(b'\n') + 1
+        tail = buff[k:]
+        if k:
+            with stats.timer('parse'):
+                sentences, offsets = check_sentences(buff[:k], offset)
+            offset += k
+            with stats.timer('group'):
+                parser.feed(sentences, offsets, offset)
+            if parser.records:
+                for batch in _batches(parser, len(parser.records)):
+                    yield batch
+        data = await reader.read(buffer_size)
+
+    with stats.timer('group'):
+        parser.flush()
+    if parser.records:
+        for batch in _batches(parser, len(parser.records)):
+            yield batch
+
+class Parser:
+    """
+    NMEA sentences parser.
+
+    The parser groups NMEA sentences into epochs and converts the epochs
+    into position records.
+
+    :var offset: Offset of data, which is not processed yet - beginning
+        of current epoch or end of processed data.
+    :var records: Position records created by the parser.
+    :var epochs: Offsets of epochs of the position records.
+    :var batch_offsets: Offsets of epochs of positions of the last batch
+        returned by the parser.
+    :var skipped: Number of skipped epochs.
+    :var _epoch: Sentences of current epoch.
+    :var _end: Offset of end of data processed so far.
+    """
+    def __init__(self, offset=0):
+        self.offset = offset
+        self.records = []
+        self.epochs = []
+        self.batch_offsets = []
+        self.skipped = 0
+        self._epoch = {}
+        self._end = offset
+
+    def feed(self, sentences, offsets, end):
+        """
+        Process NMEA sentences.
+
+        :param sentences: Collection of NMEA sentences.
+        :param offsets: Offsets of the NMEA sentences.
+        :param end: Offset of end of the data containing the sentences.
+        """
+        epoch = self._epoch
+        records = self.records
+        epochs = self.epochs
+        skipped = 0
+        offset = self.offset
+        for line, pos in zip(sentences, offsets):
+            item = line.split(b',')
+            key = item[0]
+            if key[2:] == b'RMC':
+                # new epoch starts, process the previous one
+                if epoch:
+                    r = to_record(epoch)
+                    if r is None:
+                        skipped += 1
+                    else:
+                        records.append(r)
+                        epochs.append(offset)
+                epoch = {}
+                offset = pos
+
+            if key in SENTENCES:
+                epoch[key] = item
+
+        self._epoch = epoch
+        self._end = end
+        self.skipped += skipped
+        self.offset = offset if epoch else end
+
+    def flush(self):
+        """
+        Process current epoch as it would be complete.
+
+        If position is created from the epoch, then the offset of the
+        parser is set to the end of processed data.
+        """
+        if self._epoch:
+            r = to_record(self._epoch)
+            if r is None:
+                self.skipped += 1
+            else:
+                self.records.append(r)
+                self.epochs.append(self.offset)
+                self.offset = self._end
+            self._epoch = {}
+
+    def batches(self, batch_size=BATCH_SIZE):
+        """
+        Convert position records into batches of positions of maximum size
+        and remove the records from the parser.
+
+        :param batch_size: Maximum number of positions in a batch.
+        """
+        records, epochs = self.records, self.epochs
+        self.records = []
+        self.epochs = []
+        for i in range(0, len(records), batch_size):
+            self.batch_offsets = epochs[i:i + batch_size]
+            yield PositionBatch.from_records(records[i:i + batch_size])
+
+def _batches(parser, batch_size):
+    """
+    Get batches of positions from NMEA parser and count the positions in
+    `parse` and `group` stages.
+    """
+    for batch in stats.timed_iter('group', parser.batches(batch_size)):
+        stats.count('parse', len(batch))
+        yield batch
+
+def read_sentences(f, buffer_size=BUFFER_SIZE):
+    """
+    Read NMEA sentences from binary file-like object.
+
+    The file is read in buffers of `buffer_size` bytes. Tuple of valid
+    sentences, their offsets and offset of end of processed data is
+    returned for each buffer. A sentence is returned without leading `$`
+    character and without checksum.
+
+    The last line of a file without new line character is processed only
+    if it has checksum, otherwise it is assumed to be incomplete.
+    """
+    base = f.tell()
+    tail = b''
+    buff = f.read(buffer_size)
+    while buff:
+        buff = tail + buff
+        k = buff.rfind(b'\n') + 1
+        tail = buff[k:]
+        if k:
+            yield check_sentences(buff[:k], base) + (base + k,)
+            base += k
+        buff = f.read(buffer_size)
+
+    k = tail.rfind(b'*')
+    if k >= 0 and len(tail.rstrip()) >= k + 3:
+        yield check_sentences(tail + b'\n', base) + (base + len(tail),)
+
+def check_sentences(buff, base=0):
+    """
+    Find NMEA sentences in a buffer and validate their checksums.
+
+    The buffer has to end with new line character. Sentences, which do
+    not have a checksum, are considered valid.
+
+    Tuple of valid sentences and their offsets is returned.
+
+    :param buff: Buffer of bytes containing lines of NMEA sentences.
+    :param base: Offset of the buffer.
+    """
+    data = np.frombuffer(buff, dtype=np.uint8)
+    n = len(data)
+
+    # pad the data, so checksum digits can be read beyond each line
+    data = np.concatenate((data, np.zeros(3, dtype=np.uint8)))
+
+    end = np.flatnonzero(data == ord('\n'))
+    start = np.concatenate(([0], end[:-1] + 1))
+
+    # first `$` in each line and first `*` after it; use end of data if
+    # any of them cannot be found
+    dollar = np.append(np.flatnonzero(data == ord('$')), n)
+    star = np.append(np.flatnonzero(data == ord('*')), n)
+    dollar = dollar[np.searchsorted(dollar, start)]
+    star = star[np.searchsorted(star, dollar)]
+
+    has_checksum = star < end
+
+    # xor of bytes between `$` and `*` using cumulative xor of the data
+    cx = np.bitwise_xor.accumulate(data)
+    checksum = cx[star - 1] ^ cx[dollar]
+    expected = HEX[data[star + 1]] * 16 + HEX[data[star + 2]]
+
+    valid = (dollar < end) & (
+        ~has_checksum | (star + 2 < end) & (checksum == expected)
+    )
+    stop = np.where(has_checksum, star, end - (data[end - 1] == ord('\r')))
+
+    dollar = dollar[valid]
+    items = zip(dollar.tolist(), stop[valid].tolist())
+    return [buff[i + 1:j] for i, j in items], (dollar + base).tolist()
+
+def to_record(epoch):
+    """
+    Convert epoch of NMEA sentences into position record.
+
+    The record is a tuple of timestamp (UTC), longitude, latitude,
+    altitude, heading, speed, 3D fix flag, HDOP, VDOP and PDOP.
+
+    Empty altitude, heading, speed and dilution of precision fields are
+    converted to NaN. If the epoch is incomplete, has no position or time
+    or contains invalid data, then `None` is returned.
+
+    :param epoch: Dictionary of sentence identifier and sentence fields.
+    """
+    rmc = epoch.get(b'GPRMC')
+    gga = epoch.get(b'GPGGA')
+    vtg = epoch.get(b'GPVTG')
+    gsa = epoch.get(b'GPGSA')
+
+    if not (rmc and gga and vtg and gsa) \
+            or len(rmc) < 10 or len(gga) < 10 \
+            or len(vtg) < 8 or len(gsa) < 18:
+        return None
+
+    # rmc: time, status, lat, N/S, lon, E/W, speed, track, date
+    # gga: time, lat, N/S, lon, E/W, quality, sats, hdop, altitude
+    # vtg: true track, T, magnetic track, M, speed, N, speed, K
+    # gsa: mode, fix type, 12 x satellite, pdop, hdop, vdop
+    if rmc[1] != gga[1] or not (rmc[1] and rmc[3] and rmc[5] and rmc[9]):
+        return None
+
+    try:
+        t = rmc[1]
+        d = rmc[9]
+        us = int(float(t[6:]) * 1e6) if t[6:] else 0
+        year = int(d[4:6])
+        ts = datetime(
+            year + 2000 if year < 69 else year + 1900, int(d[2:4]), int(d[:2]),
+            int(t[:2]), int(t[2:4]), int(t[4:6]), us
+        )
+
+        lat = to_degrees(float(rmc[3]))
+        if rmc[4] == b'S':
+            lat = -lat
+        lon = to_degrees(float(rmc[5]))
+        if rmc[6] == b'W':
+            lon = -lon
+
+        return (
+            ts, lon, lat, float(gga[9] or NAN),
+            float(vtg[1] or NAN), float(vtg[7] or NAN),
+            gsa[2] == b'3',
+            float(gsa[16] or NAN), float(gsa[17] or NAN),
+            float(gsa[15] or NAN),
+        )
+    except ValueError:
+        return None
+
+def to_degrees(v):
+    """
+    Convert NMEA `ddmm.mmmm` coordinate value into degrees.
+    """
+    d = v // 100
+    return d + (v - d * 100) / 60
+
+def parse_pos_pynmea2(f, batch_size=BATCH_SIZE):
+    """
+    Read batches of GPS positions from file-like object serving NMEA
+    sentences.
+
+    The sentences are parsed with pynmea2 library.
     """
     counter = Counter()
     data = (pynmea2.parse(line) for line in f)
@@ -40,11 +395,18 @@ def parse_pos(f):
         {v.identifier()[:-1]: v for v in items}
         for _, items in data
     )
-    return (to_pos(v) for v in data)
+    data = (to_pos(v) for v in data)
+    data = (r for r in data if r is not None)
+    return (
+        PositionBatch.from_records(records)
+        for records in partition_all(batch_size, data)
+    )
 
 def to_pos(item):
     """
-    Convert dictionary of NMEA sentences into position objects.
+    Convert dictionary of NMEA sentences into position record.
+
+    See `to_record` for record description.
     """
     rmc = item.get('GPRMC')
     gga = item.get('GPGGA')
@@ -57,19 +419,14 @@ def to_pos(item):
 
     assert rmc.timestamp == gga.timestamp, (rmc, gga)
 
-    ts = rmc.datetime.replace(tzinfo=timezone.utc)
-
-    p = Point(rmc.longitude, rmc.latitude, gga.altitude)
-    p.properties = {}
-    p.properties['timestamp'] = ts
-    p.properties['heading'] = vtg.true_track
-    p.properties['speed'] = vtg.spd_over_grnd_kmph
-    p.properties['is_3d'] = gsa.mode_fix_type == '3'
-    p.properties['hdop'] = float(gsa.hdop)
-    p.properties['vdop'] = float(gsa.vdop)
-    p.properties['pdop'] = float(gsa.pdop)
-
-    return p
+    return (
+        rmc.datetime.replace(tzinfo=None),  # UTC
+        rmc.longitude, rmc.latitude, gga.altitude,
+        vtg.true_track, vtg.spd_over_grnd_kmph,
+        gsa.mode_fix_type == '3',
+        float(gsa.hdop or 'nan'), float(gsa.vdop or 'nan'),
+        float(gsa.pdop or 'nan'),
+    )
 
 class Counter:
     """
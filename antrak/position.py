@@ -0,0 +1,198 @@
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Batch of positions stored in columnar format.
+"""
+
+import numpy as np
+from datetime import timezone
+from shapely.geometry import Point
+
+# position data type; timestamp is in UTC, altitude in meters, heading in
+# degrees and speed in km/h
+POS_DTYPE = np.dtype([
+    ('timestamp', 'datetime64[us]'),
+    ('lon', 'f8'),
+    ('lat', 'f8'),
+    ('alt', 'f8'),
+    ('heading', 'f8'),
+    ('speed', 'f8'),
+    ('is_3d', '?'),
+    ('hdop', 'f4'),
+    ('vdop', 'f4'),
+    ('pdop', 'f4'),
+])
+
+# EWKB of 3D point with SRID
+WKB_DTYPE = np.dtype([
+    ('order', 'u1'),
+    ('type', '<u4'),
+    ('srid', '<u4'),
+    ('x', '<f8'),
+    ('y', '<f8'),
+    ('z', '<f8'),
+])
+WKB_POINT_ZS = 0x80000001 | 0x20000000
+
+# values derived from consecutive positions of a device; step distance in
+# meters, time delta in seconds, vertical speed in m/s and cumulative
+# distance in meters
+DERIVED_DTYPE = np.dtype([
+    ('step_distance', 'f8'),
+    ('time_delta', 'f8'),
+    ('vertical_speed', 'f8'),
+    ('cum_distance', 'f8'),
+])
+
+# mean Earth radius [m]; keep in sync with `position_distance` SQL function
+EARTH_RADIUS = 6371008.8
+
+class PositionBatch:
+    """
+    Batch of positions.
+
+    Positions are stored in NumPy structured array. Shapely geometry
+    objects are created only on request.
+
+    Indexing a batch with a column name returns column array, i.e.
+    `batch['timestamp']`, otherwise a new batch is returned, i.e.
+    `batch[mask]`.
+
+    :var data: NumPy structured array of `POS_DTYPE` type.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    @staticmethod
+    def from_records(records):
+        """
+        Create batch of positions from collection of records.
+
+        Each record is a tuple of timestamp, longitude, latitude,
+        altitude, heading, speed, 3D fix flag, HDOP, VDOP and PDOP.
+        """
+        return PositionBatch(np.array(list(records), dtype=POS_DTYPE))
+
+    @staticmethod
+    def empty():
+        """
+        Create empty batch of positions.
+        """
+        return PositionBatch(np.empty(0, dtype=POS_DTYPE))
+
+    @staticmethod
+    def concat(batches):
+        """
+        Concatenate collection of batches of positions.
+        """
+        return PositionBatch(np.concatenate([b.data for b in batches]))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.data[key]
+        return PositionBatch(self.data[key])
+
+    def timestamps(self):
+        """
+        Get list of timestamps of positions as timezone aware datetime
+        objects.
+        """
+        utc = timezone.utc
+        return [t.replace(tzinfo=utc) for t in self.data['timestamp'].tolist()]
+
+    def points(self):
+        """
+        Create Shapely points of positions.
+        """
+        data = self.data
+        items = zip(data['lon'].tolist(), data['lat'].tolist(), data['alt'].tolist())
+        return [Point(*v) for v in items]
+
+    def derive(self, prev=None):
+        """
+        Calculate values derived from consecutive positions.
+
+        The positions have to be ordered by timestamp. Previous position
+        is tuple of timestamp, longitude, latitude, altitude and
+        cumulative distance. If previous position is not specified, then
+        derived values of the first position are zero.
+
+        NumPy structured array of `DERIVED_DTYPE` type is returned.
+
+        :param prev: Position preceding the positions.
+        """
+        data = self.data
+        if prev is None:
+            first = data[0]
+            prev = first['timestamp'], first['lon'], first['lat'], \
+                first['alt'], 0
+        ts, lon, lat, alt, cum = prev
+
+        ts = np.concatenate([[ts], data['timestamp']])
+        lon = np.concatenate([[lon], data['lon']])
+        lat = np.concatenate([[lat], data['lat']])
+        alt = np.concatenate([[alt], data['alt']])
+
+        result = np.empty(len(data), dtype=DERIVED_DTYPE)
+        step = distance(lon[:-1], lat[:-1], lon[1:], lat[1:])
+        td = np.diff(ts) / np.timedelta64(1, 's')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vs = np.where(td > 0, np.diff(alt) / td, 0)
+        result['step_distance'] = step
+        result['time_delta'] = td
+        result['vertical_speed'] = vs
+        result['cum_distance'] = cum + np.cumsum(step)
+        return result
+
+    def wkb(self, srid=4326):
+        """
+        Encode positions as list of EWKB points with SRID.
+
+        :param srid: SRID of the points.
+        """
+        data = self.data
+        n = len(data)
+        size = WKB_DTYPE.itemsize
+
+        buff = np.empty(n, dtype=WKB_DTYPE)
+        buff['order'] = 1
+        buff['type'] = WKB_POINT_ZS
+        buff['srid'] = srid
+        buff['x'] = data['lon']
+        buff['y'] = data['lat']
+        buff['z'] = data['alt']
+        buff = buff.tobytes()
+        return [buff[i:i + size] for i in range(0, n * size, size)]
+
+def distance(lon1, lat1, lon2, lat2):
+    """
+    Calculate distance between positions [m] with haversine formula.
+    """
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 \
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+# vim: sw=4:et:ai
@@ -0,0 +1,164 @@
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Detection of tracks in a stream of positions.
+
+Positions ordered by timestamp are split into tracks at
+
+- time gap between positions longer than maximum gap
+- distance between positions longer than maximum distance
+- stationary period, i.e. positions with speed lower than stationary
+  speed, longer than stationary period
+
+Stationary positions do not belong to a track. Tracks shorter than
+minimum duration are ignored.
+"""
+
+import numpy as np
+
+from antrak.position import distance
+
+# default maximum time [s] and distance [m] between positions of a track
+MAX_GAP = 300
+MAX_DISTANCE = 1000
+
+# default maximum speed [km/h] of stationary position and minimum time [s]
+# of stationary period splitting a track
+STATIONARY_SPEED = 2
+STATIONARY_PERIOD = 600
+
+# default minimum duration of a track [s]
+MIN_DURATION = 120
+
+ONE_SECOND = np.timedelta64(1, 's')
+
+class Segmenter:
+    """
+    Split stream of positions into tracks.
+
+    Positions are fed in chunks. Tuple of start timestamp, end timestamp
+    and number of positions is returned for each detected track.
+
+    :var max_gap: Maximum time between positions of a track [s].
+    :var max_distance: Maximum distance between positions of a track [m].
+    :var stationary_speed: Maximum speed of stationary position [km/h].
+    :var stationary_period: Minimum time of stationary period splitting
+        a track [s].
+    :var min_duration: Minimum duration of a track [s].
+    """
+    def __init__(
+            self,
+            max_gap=MAX_GAP,
+            max_distance=MAX_DISTANCE,
+            stationary_speed=STATIONARY_SPEED,
+            stationary_period=STATIONARY_PERIOD,
+            min_duration=MIN_DURATION,
+        ):
+        self.max_gap = max_gap
+        self.max_distance = max_distance
+        self.stationary_speed = stationary_speed
+        self.stationary_period = stationary_period
+        self.min_duration = min_duration
+
+        # last position and number of gaps so far
+        self._last = None
+        self._gaps = 0
+
+        # last moving position and number of gaps until the position
+        self._last_moving = None
+
+        # current track start, end and number of positions
+        self._track = None
+
+    def feed(self, ts, lon, lat, speed):
+        """
+        Process chunk of positions and return list of detected tracks.
+
+        :param ts: Array of timestamps of positions.
+        :param lon: Array of longitudes of positions.
+        :param lat: Array of latitudes of positions.
+        :param speed: Array of speeds of positions [km/h].
+        """
+        if not len(ts):
+            return []
+
+        # count gaps between consecutive positions
+        if self._last is None:
+            prev_ts, prev_lon, prev_lat = ts[0], lon[0], lat[0]
+        else:
+            prev_ts, prev_lon, prev_lat = self._last
+        ts1 = np.concatenate([[prev_ts], ts[:-1]])
+        lon1 = np.concatenate([[prev_lon], lon[:-1]])
+        lat1 = np.concatenate([[prev_lat], lat[:-1]])
+        gap = ((ts - ts1) / ONE_SECOND > self.max_gap) \
+            | (distance(lon1, lat1, lon, lat) > self.max_distance)
+        gaps = self._gaps + np.cumsum(gap)
+        self._last = ts[-1], lon[-1], lat[-1]
+        self._gaps = gaps[-1]
+
+        # split moving positions at gaps and stationary periods
+        moving = speed >= self.stationary_speed
+        ts = ts[moving]
+        gaps = gaps[moving]
+        if not len(ts):
+            return []
+
+        first = self._last_moving is None
+        if first:
+            prev_ts, prev_gaps = ts[0], gaps[0]
+        else:
+            prev_ts, prev_gaps = self._last_moving
+        ts1 = np.concatenate([[prev_ts], ts[:-1]])
+        gaps1 = np.concatenate([[prev_gaps], gaps[:-1]])
+        split = (gaps != gaps1) \
+            | ((ts - ts1) / ONE_SECOND > self.stationary_period)
+        split[0] |= first
+        self._last_moving = ts[-1], gaps[-1]
+
+        tracks = []
+        prev = 0
+        for k in np.flatnonzero(split):
+            if self._track is not None:
+                start, end, count = self._track
+                if k > 0:
+                    end = ts[k - 1]
+                self._add(tracks, start, end, count + k - prev)
+            self._track = ts[k], ts[k], 0
+            prev = k
+
+        start, _, count = self._track
+        self._track = start, ts[-1], count + len(ts) - prev
+        return tracks
+
+    def close(self):
+        """
+        Finish processing of positions and return list of detected tracks.
+        """
+        tracks = []
+        if self._track is not None:
+            self._add(tracks, *self._track)
+            self._track = None
+        return tracks
+
+    def _add(self, tracks, start, end, count):
+        if (end - start) / ONE_SECOND >= self.min_duration:
+            tracks.append((start, end, count))
+
+# vim: sw=4:et:ai
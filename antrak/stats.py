@@ -0,0 +1,251 @@
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Instrumentation of processing stages.
+
+Number of processed positions, number of dropped positions by reason,
+wall time and CPU time is recorded for each processing stage, i.e.
+parsing, grouping of NMEA sentences into epochs, filtering or writing to
+a database.
+
+Statistics are not recorded unless enabled with `enable` function. When
+disabled, the functions of the module do nothing.
+
+Stages of asynchronous code can overlap, then wall time and CPU time is
+counted in each of the overlapping stages. Statistics of worker processes
+are passed to the parent process with `collect` and `merge` functions,
+then wall time of parallel workers is summed.
+"""
+
+import time
+from collections import Counter, OrderedDict
+
+# stages in order of processing
+STAGES = (
+    'parse', 'group', 'filter', 'encode', 'write', 'query', 'render'
+)
+
+FMT_HEADER = '{:8} {:>10} {:>10} {:>10} {:>10} {:>12}'.format
+FMT_STAGE = '{:8} {:10d} {:10d} {:10.2f} {:10.2f} {:12.0f}'.format
+FMT_DROP = '    dropped: {}'.format
+
+# statistics of stages, null if disabled
+_stats = None
+
+class Stage:
+    """
+    Statistics of a processing stage.
+
+    :var count: Number of processed positions.
+    :var drops: Counter of dropped positions by reason.
+    :var wall: Wall time of the stage [s].
+    :var cpu: CPU time of the stage [s].
+    """
+    __slots__ = ('count', 'drops', 'wall', 'cpu')
+
+    def __init__(self):
+        self.count = 0
+        self.drops = Counter()
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'drops': dict(self.drops),
+            'wall': self.wall,
+            'cpu': self.cpu,
+            'rate': self.count / self.wall if self.wall else None,
+        }
+
+class Timer:
+    """
+    Context manager measuring wall and CPU time of a stage.
+    """
+    __slots__ = ('stage', 'count', 'wall', 'cpu')
+
+    def __init__(self, stage, count):
+        self.stage = stage
+        self.count = count
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *args):
+        stage = self.stage
+        stage.wall += time.perf_counter() - self.wall
+        stage.cpu += time.process_time() - self.cpu
+        stage.count += self.count
+
+class NullTimer:
+    """
+    Context manager used when statistics are disabled.
+
+    Number of processed positions can be set, but it is ignored.
+    """
+    __slots__ = ('count',)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+NULL_TIMER = NullTimer()
+
+def enable():
+    """
+    Enable recording of statistics.
+    """
+    global _stats
+    _stats = OrderedDict((s, Stage()) for s in STAGES)
+
+def enabled():
+    """
+    Check if recording of statistics is enabled.
+    """
+    return _stats is not None
+
+def timer(name, count=0):
+    """
+    Create context manager measuring time of a stage.
+
+    :param name: Stage name.
+    :param count: Number of positions processed by the stage.
+    """
+    if _stats is None:
+        return NULL_TIMER
+    return Timer(_stage(name), count)
+
+def timed_iter(name, batches):
+    """
+    Measure time of a stage producing batches of positions.
+
+    Time of getting each batch is measured and number of positions is
+    counted. The batches are returned unchanged if statistics are
+    disabled.
+
+    :param name: Stage name.
+    :param batches: Iterable of batches of positions.
+    """
+    if _stats is None:
+        return batches
+    return _timed_iter(_stage(name), batches)
+
+def count(name, n):
+    """
+    Count positions processed by a stage.
+
+    :param name: Stage name.
+    :param n: Number of positions.
+    """
+    if _stats is not None:
+        _stage(name).count += n
+
+def drop(name, reason, n):
+    """
+    Count positions dropped by a stage.
+
+    :param name: Stage name.
+    :param reason: Reason of dropping the positions.
+    :param n: Number of positions.
+    """
+    if _stats is not None and n:
+        _stage(name).drops[reason] += n
+
+def collect():
+    """
+    Get statistics of stages and reset them.
+
+    Used by worker processes to pass their statistics to the parent
+    process, see `merge`. Null is returned if statistics are disabled.
+    """
+    if _stats is None:
+        return None
+    data = {
+        n: (s.count, dict(s.drops), s.wall, s.cpu)
+        for n, s in _stats.items()
+    }
+    enable()
+    return data
+
+def merge(data):
+    """
+    Add statistics collected with `collect` function, i.e. by a worker
+    process.
+
+    :param data: Statistics of stages or null.
+    """
+    if _stats is None or data is None:
+        return
+    for name, (n, drops, wall, cpu) in data.items():
+        stage = _stage(name)
+        stage.count += n
+        stage.drops.update(drops)
+        stage.wall += wall
+        stage.cpu += cpu
+
+def summary():
+    """
+    Create text summary of statistics of stages.
+    """
+    lines = [FMT_HEADER(
+        'stage', 'count', 'dropped', 'wall [s]', 'cpu [s]', 'rate [1/s]'
+    )]
+    for name, stage in _stats.items():
+        if not (stage.count or stage.wall or stage.drops):
+            continue
+        rate = stage.count / stage.wall if stage.wall else 0
+        lines.append(FMT_STAGE(
+            name, stage.count, sum(stage.drops.values()), stage.wall,
+            stage.cpu, rate
+        ))
+        if stage.drops:
+            lines.append(FMT_DROP(', '.join(
+                '{}={}'.format(*v) for v in sorted(stage.drops.items())
+            )))
+    return '\n'.join(lines)
+
+def as_dict():
+    """
+    Get statistics of stages as dictionary.
+    """
+    return OrderedDict((n, s.as_dict()) for n, s in _stats.items())
+
+def _stage(name):
+    stage = _stats.get(name)
+    if stage is None:
+        stage = _stats[name] = Stage()
+    return stage
+
+def _timed_iter(stage, batches):
+    items = iter(batches)
+    while True:
+        with Timer(stage, 0) as t:
+            try:
+                batch = next(items)
+            except StopIteration:
+                return
+            t.count = len(batch)
+        yield batch
+
+# vim: sw=4:et:ai
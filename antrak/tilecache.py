@@ -0,0 +1,278 @@
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Caches of map tiles.
+
+Map tiles are stored in a directory on disk or in Redis. A cache is
+converted into GeoTiler downloader with `TileCache.downloader` method.
+"""
+
+import abc
+import fcntl
+import hashlib
+import logging
+import os
+import tempfile
+from collections import Counter
+from functools import partial
+from geotiler.cache import caching_downloader
+from geotiler.tile.io import fetch_tiles
+
+logger = logging.getLogger(__name__)
+
+# types of map tiles caches
+CACHES = ('disk', 'redis')
+
+# default directory and maximum size [MiB] of disk cache
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'antrak', 'tiles'
+)
+CACHE_SIZE = 512
+
+# size of disk cache after eviction relative to its maximum size
+EVICT_RATIO = 0.9
+
+# file in disk cache directory storing estimated size of the cache
+SIZE_FILE = '.size'
+
+# Redis host and expiry timeout [s] of map tiles in Redis
+REDIS_HOST = 'localhost'
+REDIS_TIMEOUT = 3600 * 24 * 7
+
+class TileCache(abc.ABC):
+    """
+    Cache of map tiles.
+
+    :var stats: Counter of cache hits, misses and evictions.
+    """
+    def __init__(self):
+        self.stats = Counter(hit=0, miss=0, eviction=0)
+
+    def get(self, key):
+        """
+        Get map tile data from the cache or `None` if not in the cache.
+
+        :param key: Map tile URL.
+        """
+        data = self._get(key)
+        self.stats['miss' if data is None else 'hit'] += 1
+        return data
+
+    def set(self, key, data):
+        """
+        Put map tile data in the cache.
+
+        :param key: Map tile URL.
+        :param data: Map tile data.
+        """
+        if data is not None:
+            self._set(key, data)
+
+    def downloader(self):
+        """
+        Create GeoTiler downloader using the cache.
+        """
+        return partial(caching_downloader, self.get, self.set, fetch_tiles)
+
+    @abc.abstractmethod
+    def _get(self, key):
+        """
+        Get map tile data from the cache storage or `None` if not stored.
+        """
+
+    @abc.abstractmethod
+    def _set(self, key, data):
+        """
+        Store map tile data in the cache storage.
+        """
+
+class DiskCache(TileCache):
+    """
+    Cache of map tiles stored in a directory.
+
+    Map tile is stored in a file in a subdirectory of the cache directory,
+    named with SHA-1 hash of map tile URL.
+
+    Modification time of a file is updated on cache hit. When size of the
+    cache exceeds its maximum size, then the least recently used files
+    are removed.
+
+    Files are written to a temporary file and renamed, so the cache can be
+    shared by multiple processes.
+
+    Estimated size of the cache is stored in `SIZE_FILE` file of the cache
+    directory, so the directory is not scanned each time the cache is
+    created. The file is locked when the size is updated, so the size
+    includes files written by all processes sharing the cache.
+
+    :var path: Cache directory.
+    :var max_size: Maximum size of the cache in bytes.
+    """
+    def __init__(self, path=CACHE_DIR, max_size=CACHE_SIZE * 1024 ** 2):
+        super().__init__()
+        self.path = path
+        self.max_size = max_size
+
+        # store the size before a tile is written, so the tile is not
+        # counted twice
+        self._update_size(lambda size: size)
+
+    @property
+    def size(self):
+        """
+        Estimated size of the cache in bytes.
+        """
+        return self._update_size(lambda size: size)
+
+    def _get(self, key):
+        fn = self._filename(key)
+        try:
+            with open(fn, 'rb') as f:
+                data = f.read()
+            os.utime(fn)
+        except FileNotFoundError:
+            data = None
+        return data
+
+    def _set(self, key, data):
+        fn = self._filename(key)
+        if os.path.exists(fn):
+            return
+
+        dirname = os.path.dirname(fn)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, fn)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        size = self._update_size(lambda size: size + len(data))
+        if size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used files from the cache.
+        """
+        self._update_size(self._evict)
+
+    def _evict(self, size):
+        """
+        Remove the least recently used files and return size of the
+        cache.
+        """
+        files = sorted(self._files())
+        total = sum(size for _, _, size in files)
+        limit = self.max_size * EVICT_RATIO
+        for _, fn, size in files:
+            if total <= limit:
+                break
+            try:
+                os.unlink(fn)
+                self.stats['eviction'] += 1
+            except FileNotFoundError:
+                pass  # removed by other process
+            total -= size
+        return total
+
+    def _update_size(self, update):
+        """
+        Update estimated size of the cache stored in the size file.
+
+        The size file is locked during the update. Function `update`
+        receives the current size of the cache and returns its new size,
+        which is stored in the file and returned. If the size is not
+        stored yet, then the size of the cached files is calculated.
+
+        :param update: Function updating size of the cache.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        fd = os.open(os.path.join(self.path, SIZE_FILE), os.O_RDWR | os.O_CREAT)
+        with os.fdopen(fd, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                size = int(f.read())
+            except ValueError:
+                size = sum(size for _, _, size in self._files())
+            size = update(size)
+            f.seek(0)
+            f.truncate()
+            f.write(str(size))
+        return size
+
+    def _filename(self, key):
+        h = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.path, h[:2], h[2:])
+
+    def _files(self):
+        """
+        Get modification time, file name and size of each cached file.
+        """
+        for dirpath, _, files in os.walk(self.path):
+            for fn in files:
+                if fn.startswith('.'):
+                    continue  # file being written
+                fn = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(fn)
+                except FileNotFoundError:
+                    continue
+                yield st.st_mtime, fn, st.st_size
+
+class RedisCache(TileCache):
+    """
+    Cache of map tiles stored in Redis.
+
+    Map tiles expire after `REDIS_TIMEOUT` seconds.
+    """
+    def __init__(self, host=REDIS_HOST, timeout=REDIS_TIMEOUT):
+        import redis
+
+        super().__init__()
+        self.client = redis.Redis(host)
+        self.timeout = timeout
+
+    def _get(self, key):
+        return self.client.get(key)
+
+    def _set(self, key, data):
+        self.client.setex(key, self.timeout, data)
+
+def create_cache(cache, path=CACHE_DIR, max_size=CACHE_SIZE):
+    """
+    Create cache of map tiles.
+
+    :param cache: Type of the cache, see `CACHES`.
+    :param path: Disk cache directory.
+    :param max_size: Maximum size of disk cache [MiB].
+    """
+    if cache == 'disk':
+        return DiskCache(path, max_size * 1024 ** 2)
+    elif cache == 'redis':
+        return RedisCache()
+    else:
+        raise ValueError('Unknown map tiles cache: {}'.format(cache))
+
+# vim: sw=4:et:ai
@@ -27,12 +27,24 @@ import wkbheader
 # flatten collection of iterables
 flatten = itertools.chain.from_iterable
 
+async def to_async(items):
+    """
+    Convert iterable into asynchronous iterable.
+    """
+    for item in items:
+        yield item
+
 def to_wkb(geom):
     """
     Convert Shapely geometry to WKB format with WGS-84 SRID.
 
-    :param geom: Shapely geometry.
+    Geometry already encoded as EWKB, i.e. see
+    `antrak.position.PositionBatch.wkb` method, is returned as is.
+
+    :param geom: Shapely geometry or EWKB bytes.
     """
+    if isinstance(geom, bytes):
+        return geom
     # TODO: remove hardcoding
     return wkbheader.set_srid(geom.wkb, 4326)
 
@@ -0,0 +1,199 @@
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Generators of synthetic tracks for benchmarks.
+
+A track is a random walk starting at `START` location with one position
+per second. Positions have noise, some positions have bad dilution of
+precision values and some positions have altitude spikes, so they are
+rejected by position filters. Course of some positions is unknown (NaN)
+and its NMEA fields are empty.
+
+Generated data is reproducible for given seed.
+"""
+
+import numpy as np
+import operator
+from functools import reduce
+
+# start time and location of a track
+START_TIME = np.datetime64('2018-01-01T00:00:00', 's')
+START = (-6.2, 51.4)
+
+# number of positions generated at once
+CHUNK = 10000
+
+# ratio of positions with bad dilution of precision and altitude spikes
+BAD_DOP_RATIO = 0.01
+ALT_SPIKE_RATIO = 0.005
+
+# ratio of positions with unknown course
+NO_COURSE_RATIO = 0.005
+
+# mean Earth radius [m]
+EARTH_RADIUS = 6371008.8
+
+TRACK_DTYPE = np.dtype([
+    ('timestamp', 'datetime64[s]'),
+    ('lon', 'f8'),
+    ('lat', 'f8'),
+    ('alt', 'f8'),
+    ('heading', 'f8'),
+    ('speed', 'f8'),
+    ('hdop', 'f4'),
+    ('vdop', 'f4'),
+    ('pdop', 'f4'),
+])
+
+GPX_HEADER = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" creator="antrak-benchmark"
+    xmlns="http://www.topografix.com/GPX/1/1">
+<trk><trkseg>
+"""
+GPX_FOOTER = '</trkseg></trk>\n</gpx>\n'
+FMT_GPX_POINT = (
+    '<trkpt lat="{:.7f}" lon="{:.7f}"><ele>{:.1f}</ele>'
+    '<time>{}Z</time></trkpt>\n'
+).format
+
+def track(n, seed=1):
+    """
+    Generate track of `n` positions in chunks.
+
+    Iterator of NumPy arrays of `TRACK_DTYPE` type is returned.
+
+    :param n: Number of positions.
+    :param seed: Seed of random number generator.
+    """
+    rng = np.random.RandomState(seed)
+    lon, lat = START
+    alt = 50.0
+    heading = 0.0
+    for k in range(0, n, CHUNK):
+        size = min(CHUNK, n - k)
+        data = np.empty(size, dtype=TRACK_DTYPE)
+        data['timestamp'] = START_TIME + np.arange(k, k + size)
+
+        # speed [km/h] and heading [deg] with noise
+        speed = np.abs(15 + 5 * np.sin(np.arange(k, k + size) / 600))
+        speed += rng.normal(0, 0.5, size)
+        speed = np.abs(speed)
+        turn = rng.normal(0, 2, size)
+        hd = (heading + np.cumsum(turn)) % 360
+        heading = hd[-1]
+
+        # move by speed in heading direction; 3m noise of position
+        dist = speed / 3.6
+        dy = dist * np.cos(np.radians(hd))
+        dx = dist * np.sin(np.radians(hd))
+        lat_d = np.degrees(np.cumsum(dy) / EARTH_RADIUS)
+        lon_d = np.degrees(
+            np.cumsum(dx) / (EARTH_RADIUS * np.cos(np.radians(lat)))
+        )
+        noise = np.degrees(rng.normal(0, 3, (size, 2)) / EARTH_RADIUS)
+        data['lon'] = lon + lon_d + noise[:, 0]
+        data['lat'] = lat + lat_d + noise[:, 1]
+        lon += lon_d[-1]
+        lat += lat_d[-1]
+
+        # altitude with noise and spikes
+        z = alt + np.cumsum(rng.normal(0, 0.2, size))
+        alt = z[-1]
+        spikes = rng.random_sample(size) < ALT_SPIKE_RATIO
+        z[spikes] += rng.choice([-200, 200], spikes.sum())
+        data['alt'] = z
+
+        data['heading'] = hd
+        data['speed'] = speed
+
+        # dilution of precision, some values are bad
+        data['hdop'] = rng.uniform(0.7, 1.5, size)
+        data['vdop'] = rng.uniform(1.0, 2.0, size)
+        data['pdop'] = rng.uniform(1.5, 2.5, size)
+        bad = rng.random_sample(size) < BAD_DOP_RATIO
+        data['pdop'][bad] = rng.uniform(6, 20, bad.sum())
+
+        no_course = rng.random_sample(size) < NO_COURSE_RATIO
+        data['heading'][no_course] = np.nan
+
+        yield data
+
+def sentence(data):
+    checksum = reduce(operator.xor, data.encode(), 0)
+    return '${}*{:02X}\r\n'.format(data, checksum)
+
+def nmea_coord(value, width):
+    value = abs(value)
+    deg = int(value)
+    return '{:0{}d}{:07.4f}'.format(deg, width, (value - deg) * 60)
+
+def nmea(n, seed=1):
+    """
+    Generate NMEA sentences of track of `n` positions.
+
+    Each epoch consists of RMC, GGA, VTG and GSA sentences. Course fields
+    of RMC and VTG sentences are empty if course is unknown.
+
+    :param n: Number of positions.
+    :param seed: Seed of random number generator.
+    """
+    for data in track(n, seed):
+        for item in data.tolist():
+            ts, lon, lat, alt, heading, speed, hdop, vdop, pdop = item
+            tm = ts.strftime('%H%M%S.00')
+            dt = ts.strftime('%d%m%y')
+            lat = '{},{}'.format(nmea_coord(lat, 2), 'N' if lat >= 0 else 'S')
+            lon = '{},{}'.format(nmea_coord(lon, 3), 'E' if lon >= 0 else 'W')
+            heading = '' if np.isnan(heading) else '{:.1f}'.format(heading)
+            yield sentence('GPRMC,{},A,{},{},{:.1f},{},{},,'.format(
+                tm, lat, lon, speed / 1.852, heading, dt
+            ))
+            yield sentence(
+                'GPGGA,{},{},{},1,08,{:.1f},{:.1f},M,46.9,M,,'
+                .format(tm, lat, lon, hdop, alt)
+            )
+            yield sentence('GPVTG,{},T,,M,{:.1f},N,{:.1f},K'.format(
+                heading, speed / 1.852, speed
+            ))
+            yield sentence(
+                'GPGSA,A,3,04,05,,09,12,,,24,,,,,{:.1f},{:.1f},{:.1f}'
+                .format(pdop, hdop, vdop)
+            )
+
+def gpx(n, seed=1):
+    """
+    Generate GPX document of track of `n` positions.
+
+    :param n: Number of positions.
+    :param seed: Seed of random number generator.
+    """
+    yield GPX_HEADER
+    for data in track(n, seed):
+        ts = data['timestamp'].astype(str)
+        items = zip(
+            data['lat'].tolist(), data['lon'].tolist(),
+            data['alt'].tolist(), ts
+        )
+        for lat, lon, alt, t in items:
+            yield FMT_GPX_POINT(lat, lon, alt, t)
+    yield GPX_FOOTER
+
+# vim: sw=4:et:ai
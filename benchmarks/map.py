@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Throughput benchmark of drawing positions on a map.
+
+Compares drawing of each position with separate cairo calls with drawing
+of all positions as single cairo path. Map tiles are not downloaded.
+"""
+
+import argparse
+import cairocffi as cairo
+import geotiler
+import math
+import numpy as np
+import time
+
+from antrak.bc.map import rev_geocode, draw_pos, ALPHA, RADIUS
+
+EXTENT = (-6.5, 51.2, -5.8, 51.6)
+
+def generate(n):
+    """
+    Generate array of `n` positions within benchmark map extent.
+    """
+    rng = np.random.RandomState(1)
+    lon = rng.uniform(EXTENT[0], EXTENT[2], n)
+    lat = rng.uniform(EXTENT[1], EXTENT[3], n)
+    return np.column_stack([lon, lat])
+
+def draw_point(cr, mm, positions, style):
+    for x, y in (mm.rev_geocode(p) for p in positions):
+        cr.set_source_rgba(1.0, 0.0, 0.0, ALPHA)
+        cr.arc(x, y, RADIUS, 0, 2 * math.pi)
+        cr.fill()
+        cr.stroke()
+
+def draw_path(cr, mm, positions, style):
+    draw_pos(cr, rev_geocode(mm, positions), style)
+
+def run(draw, mm, positions, style):
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, *mm.size)
+    cr = cairo.Context(surface)
+    t1 = time.perf_counter()
+    draw(cr, mm, positions, style)
+    surface.flush()
+    t2 = time.perf_counter()
+    return len(positions) / (t2 - t1)
+
+parser = argparse.ArgumentParser(description='Map drawing benchmark')
+parser.add_argument(
+    '-n', dest='n', type=int, default=200000,
+    help='number of positions (default: %(default)s)'
+)
+parser.add_argument(
+    '-s', '--size', dest='size', nargs=2, type=int, default=(1920, 1080),
+    help='size of map image'
+)
+args = parser.parse_args()
+
+mm = geotiler.Map(size=args.size, extent=EXTENT, provider='osm')
+positions = generate(args.n)
+
+items = [
+    ('per point', draw_point, 'dots'),
+    ('path, dots', draw_path, 'dots'),
+    ('path, line', draw_path, 'line'),
+]
+for name, draw, style in items:
+    rate = run(draw, mm, positions, style)
+    print('{:12s}: {:10.0f} points/s'.format(name, rate))
+
+# vim: sw=4:et:ai
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Throughput benchmark of NMEA parsers.
+
+Compares the fast NMEA parser with the parser based on pynmea2 library
+using generated NMEA data. Positions parsed by both parsers are checked
+to be equal.
+"""
+
+import argparse
+import io
+import time
+
+import numpy as np
+
+from antrak.nmea import parse_pos, parse_pos_pynmea2
+from antrak.position import PositionBatch
+from generator import nmea
+
+def run(name, parser, data, n):
+    start = time.perf_counter()
+    batches = list(parser(data))
+    elapsed = time.perf_counter() - start
+    count = sum(len(b) for b in batches)
+    assert count == n, (count, n)
+    print('{:10} {:9} positions {:8.2f}s {:10.0f} positions/s'.format(
+        name, count, elapsed, count / elapsed
+    ))
+    return PositionBatch.concat(batches)
+
+def check_equal(expected, result):
+    """
+    Check that batches of positions are equal; NaN values are equal.
+    """
+    for name in expected.data.dtype.names:
+        a, b = expected[name], result[name]
+        if a.dtype.kind == 'f':
+            equal = np.allclose(a, b, rtol=0, atol=1e-9, equal_nan=True)
+        else:
+            equal = (a == b).all()
+        assert equal, 'values of {} differ'.format(name)
+
+parser = argparse.ArgumentParser(description='NMEA parsers benchmark')
+parser.add_argument(
+    '-n', dest='n', type=int, default=100000,
+    help='number of positions to parse'
+)
+parser.add_argument(
+    '--seed', dest='seed', type=int, default=1,
+    help='seed of random number generator (default: %(default)s)'
+)
+args = parser.parse_args()
+
+data = ''.join(nmea(args.n, args.seed))
+expected = run('pynmea2', parse_pos_pynmea2, io.StringIO(data), args.n)
+result = run('fast', parse_pos, io.BytesIO(data.encode()), args.n)
+check_equal(expected, result)
+
+# vim: sw=4:et:ai
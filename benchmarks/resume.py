@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Check of resumed import of growing NMEA file.
+
+Generated NMEA file grows in parts, which are split at random offsets,
+and it is imported after each part is appended. The positions are
+compared with positions of full import of the file. SQLite storage is
+used, i.e.
+
+    $ PYTHONPATH=.:benchmarks benchmarks/resume.py -n 10000 -p 20
+"""
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import tempfile
+
+import numpy as np
+
+import generator
+from antrak.bc.track import save_pos
+from antrak.db import tx
+
+DEVICE = 'resume'
+
+SQL_POS = """
+select timestamp, lon, lat, alt, heading, speed,
+    step_distance, time_delta, vertical_speed, cum_distance
+from position
+order by timestamp
+"""
+
+async def import_file(dsn, fn, full=False):
+    tx.dsn = dsn
+    try:
+        await save_pos(DEVICE, [fn], full=full)
+    finally:
+        await tx.close()
+
+def load(path):
+    conn = sqlite3.connect(path)
+    try:
+        data = conn.execute(SQL_POS).fetchall()
+    finally:
+        conn.close()
+    return np.array(data, dtype=float).reshape(-1, 10)
+
+parser = argparse.ArgumentParser(description='Resumed import check')
+parser.add_argument(
+    '-n', dest='n', type=int, default=5000,
+    help='number of positions (default: %(default)s)'
+)
+parser.add_argument(
+    '-p', dest='parts', type=int, default=10,
+    help='number of parts of the file (default: %(default)s)'
+)
+parser.add_argument(
+    '--seed', dest='seed', type=int, default=1,
+    help='seed of random number generator (default: %(default)s)'
+)
+args = parser.parse_args()
+
+data = ''.join(generator.nmea(args.n, args.seed)).encode()
+rng = np.random.RandomState(args.seed)
+splits = np.sort(rng.randint(0, len(data), args.parts - 1)).tolist()
+
+loop = asyncio.get_event_loop()
+with tempfile.TemporaryDirectory() as path:
+    fn = os.path.join(path, 'track.nmea')
+    dsn = 'sqlite:{}/{{}}.db'.format(path)
+
+    start = 0
+    for end in splits + [len(data)]:
+        with open(fn, 'ab') as f:
+            f.write(data[start:end])
+        loop.run_until_complete(import_file(dsn.format('resume'), fn))
+        start = end
+    loop.run_until_complete(import_file(dsn.format('full'), fn, full=True))
+
+    resumed = load(os.path.join(path, 'resume.db'))
+    full = load(os.path.join(path, 'full.db'))
+
+print('positions: resumed={}, full={}'.format(len(resumed), len(full)))
+assert len(resumed) == len(full), 'number of positions differs'
+assert np.array_equal(resumed[:, :6], full[:, :6], equal_nan=True), \
+    'positions differ'
+assert np.allclose(resumed[:, 6:], full[:, 6:], equal_nan=True), \
+    'derived values differ'
+
+# vim: sw=4:et:ai
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Startup time benchmark of AnTrak commands.
+
+Help of each command is displayed, which measures time of parsing of
+command line arguments. Commands not requiring network access are also
+executed with empty SQLite storage. Results are written in JSON format,
+i.e.
+
+    $ PYTHONPATH=. benchmarks/startup.py -n 20 -o startup.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ANTRAK = os.path.join(os.path.dirname(__file__), '..', 'bin', 'antrak')
+
+# commands and their arguments used when the commands are executed, null
+# if a command is not executed
+COMMANDS = (
+    ('import', ['{path}/empty.nmea']),
+    ('ingest', None),
+    ('track list', []),
+    ('track set', None),
+    ('track detect', []),
+    ('report stats', ['trip']),
+    ('export', ['{path}/export']),
+    ('map', None),
+)
+
+def timed(cmd):
+    """
+    Run command and return its run time.
+    """
+    start = time.perf_counter()
+    subprocess.run(
+        cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return time.perf_counter() - start
+
+def result(command, mode, times):
+    return {
+        'command': command,
+        'mode': mode,
+        'min': min(times),
+        'median': statistics.median(times),
+    }
+
+def run(command, args, n, path):
+    """
+    Run benchmarks of a command.
+    """
+    cmd = [sys.executable, ANTRAK] + command.split()
+    yield result(command, 'help', [timed(cmd + ['-h']) for _ in range(n)])
+
+    if args is not None:
+        dsn = 'sqlite:{}/antrak.db'.format(path)
+        cmd = [sys.executable, ANTRAK, '--dsn', dsn] + command.split() \
+            + [a.format(path=path) for a in args]
+        yield result(command, 'run', [timed(cmd) for _ in range(n)])
+
+parser = argparse.ArgumentParser(description='AnTrak startup benchmark')
+parser.add_argument(
+    '-n', dest='repeat', type=int, default=10,
+    help='number of runs of each command (default: %(default)s)'
+)
+parser.add_argument(
+    '-c', '--command', dest='commands', nargs='+',
+    choices=[c for c, _ in COMMANDS], default=[c for c, _ in COMMANDS],
+    help='benchmarked commands (default: all)'
+)
+parser.add_argument(
+    '-o', '--output', dest='output',
+    help='output file (default: standard output)'
+)
+args = parser.parse_args()
+
+results = []
+with tempfile.TemporaryDirectory() as path:
+    open(os.path.join(path, 'empty.nmea'), 'w').close()
+    for command, cmd_args in COMMANDS:
+        if command not in args.commands:
+            continue
+        for item in run(command, cmd_args, args.repeat, path):
+            print(
+                '{command:14} {mode:5} {min:8.3f}s {median:8.3f}s'
+                .format(**item),
+                file=sys.stderr
+            )
+            results.append(item)
+
+data = {
+    'timestamp': datetime.utcnow().isoformat(),
+    'python': platform.python_version(),
+    'repeat': args.repeat,
+    'results': results,
+}
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump(data, f, indent=2)
+else:
+    json.dump(data, sys.stdout, indent=2)
+
+# vim: sw=4:et:ai
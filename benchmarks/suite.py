@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+#
+# AnTrak - Activity and location data analysis
+#
+# Copyright (C) 2017-2018 by Artur Wroblewski <wrobell@riseup.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Benchmark suite of AnTrak.
+
+Generated NMEA and GPX files are parsed, parsed positions are filtered,
+imported into a database and reported. Map is drawn using map tiles from
+stub tile downloader. Results are written in JSON format, i.e.
+
+    $ PYTHONPATH=. benchmarks/suite.py -n 10000 100000 -o results.json
+
+Database stages are run only if database connection string is specified.
+Use throwaway database created with `db/create` script. Positions and
+tracks of `DEVICE` device are removed before and after the benchmark.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+import numpy as np
+
+import generator
+from antrak import gpx, nmea
+from antrak.bc.track import filter_quality, filter_altitude_speed
+from antrak.dao import report as report_dao
+from antrak.dao import track as track_dao
+from antrak.db import tx
+from antrak.util import to_async
+
+STAGES = ('parse', 'filter', 'import', 'report', 'map')
+
+# device used by database benchmarks
+DEVICE = 'benchmark'
+
+SQL_CLEAN = (
+    'delete from track where device = $1',
+    'delete from position where device = $1',
+)
+
+MAP_SIZE = (1920, 1080)
+
+def timed(f, *args):
+    """
+    Run function and return its result and run time.
+    """
+    start = time.perf_counter()
+    result = f(*args)
+    return result, time.perf_counter() - start
+
+def atimed(coro):
+    """
+    Run coroutine and return its result and run time.
+    """
+    loop = asyncio.get_event_loop()
+    return timed(loop.run_until_complete, coro)
+
+def result(stage, fmt, n, count, elapsed):
+    return {
+        'stage': stage,
+        'format': fmt,
+        'size': n,
+        'count': count,
+        'time': elapsed,
+        'rate': count / elapsed if elapsed else None,
+    }
+
+def generate(fmt, n, seed, path):
+    """
+    Generate file with track of `n` positions.
+    """
+    gen = generator.nmea if fmt == 'nmea' else generator.gpx
+    fn = os.path.join(path, 'track-{}.{}'.format(n, fmt))
+    with open(fn, 'w') as f:
+        f.writelines(gen(n, seed))
+    return fn
+
+def parse(fmt, fn):
+    with open(fn, 'rb') as f:
+        parser = nmea.parse_pos if fmt == 'nmea' else gpx.parse_points
+        return list(parser(f))
+
+def filter_pos(batches):
+    rejected = Counter()
+    data = filter_quality(batches, rejected=rejected)
+    data = filter_altitude_speed(data, rejected=rejected)
+    return list(data)
+
+@tx
+async def clean():
+    for sql in SQL_CLEAN:
+        await tx.conn.execute(sql, DEVICE)
+
+@tx
+async def import_pos(batches):
+    return (await track_dao.save_pos(DEVICE, to_async(batches)))
+
+@tx
+async def report(batches):
+    start = min(b['timestamp'].min() for b in batches if len(b))
+    end = max(b['timestamp'].max() for b in batches if len(b))
+    start, end = (
+        v.astype(datetime).replace(tzinfo=timezone.utc) for v in (start, end)
+    )
+    await track_dao.add(DEVICE, 'benchmark', 'track', start, end)
+    await track_dao.update_stats(DEVICE, trip='benchmark', name='track')
+    return (await report_dao.track_summary(DEVICE, 'benchmark track'))
+
+async def stub_downloader(tiles, num_workers, **kw):
+    """
+    Map tiles downloader providing blank map tiles.
+    """
+    from PIL import Image
+
+    buff = io.BytesIO()
+    Image.new('RGB', (256, 256), (255, 255, 255)).save(buff, 'png')
+    data = buff.getvalue()
+    for t in tiles:
+        yield t._replace(img=data, error=None)
+
+def draw_map(batches, path):
+    import geotiler
+    from antrak.bc.map import render_map
+
+    batch = np.concatenate([b.data for b in batches])
+    positions = np.column_stack([batch['lon'], batch['lat']])
+    extent = (*positions.min(axis=0), *positions.max(axis=0))
+    mm = geotiler.Map(size=MAP_SIZE, extent=extent, provider='osm')
+    output = os.path.join(path, 'map.png')
+    return atimed(render_map(stub_downloader, mm, positions, output))[1]
+
+def run(fmt, n, seed, stages, path):
+    """
+    Run benchmarks for a file format and a number of positions.
+    """
+    fn = generate(fmt, n, seed, path)
+
+    batches, elapsed = timed(parse, fmt, fn)
+    count = sum(len(b) for b in batches)
+    if 'parse' in stages:
+        yield result('parse', fmt, n, count, elapsed)
+
+    batches, elapsed = timed(filter_pos, batches)
+    if 'filter' in stages:
+        yield result('filter', fmt, n, count, elapsed)
+    count = sum(len(b) for b in batches)
+
+    if 'import' in stages:
+        atimed(clean())
+        saved, elapsed = atimed(import_pos(batches))
+        yield result('import', fmt, n, saved, elapsed)
+
+        if 'report' in stages:
+            _, elapsed = atimed(report(batches))
+            yield result('report', fmt, n, count, elapsed)
+        atimed(clean())
+
+    if 'map' in stages:
+        yield result('map', fmt, n, count, draw_map(batches, path))
+
+    os.unlink(fn)
+
+parser = argparse.ArgumentParser(description='AnTrak benchmark suite')
+parser.add_argument(
+    '-n', dest='sizes', nargs='+', type=int, default=[10000, 100000],
+    help='numbers of positions (default: %(default)s)'
+)
+parser.add_argument(
+    '-f', '--format', dest='formats', nargs='+', choices=('nmea', 'gpx'),
+    default=['nmea', 'gpx'], help='file formats (default: %(default)s)'
+)
+parser.add_argument(
+    '-s', '--stage', dest='stages', nargs='+', choices=STAGES,
+    default=['parse', 'filter', 'map'],
+    help='benchmark stages (default: %(default)s)'
+)
+parser.add_argument(
+    '--seed', dest='seed', type=int, default=1,
+    help='seed of random number generator (default: %(default)s)'
+)
+parser.add_argument(
+    '--dsn', dest='dsn',
+    help='connection string of throwaway database, required by import'
+    ' and report stages'
+)
+parser.add_argument(
+    '-o', '--output', dest='output',
+    help='output file (default: standard output)'
+)
+args = parser.parse_args()
+
+stages = set(args.stages)
+if stages & {'import', 'report'}:
+    if not args.dsn:
+        parser.error('database connection string required')
+    tx.dsn = args.dsn
+    stages.add('import')
+
+results = []
+with tempfile.TemporaryDirectory() as path:
+    for fmt in args.formats:
+        for n in args.sizes:
+            for item in run(fmt, n, args.seed, stages, path):
+                print(
+                    '{stage:8} {format:5} {size:9} {rate:12.0f} positions/s'
+                    .format(**item),
+                    file=sys.stderr
+                )
+                results.append(item)
+
+if stages & {'import', 'report'}:
+    asyncio.get_event_loop().run_until_complete(tx.close())
+
+data = {
+    'timestamp': datetime.utcnow().isoformat(),
+    'python': platform.python_version(),
+    'numpy': np.__version__,
+    'seed': args.seed,
+    'results': results,
+}
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump(data, f, indent=2)
+else:
+    json.dump(data, sys.stdout, indent=2)
+
+# vim: sw=4:et:ai
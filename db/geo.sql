@@ -1,2 +1,3 @@
 drop extension if exists postgis cascade;
 create extension postgis;
+create extension if not exists pg_trgm;
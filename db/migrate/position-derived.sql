@@ -0,0 +1,41 @@
+-- add and calculate values derived from consecutive positions of
+-- a device
+--
+--     psql -f db/migrate/position-derived.sql antrak
+
+begin;
+
+\ir ../schema/position_distance.sql
+
+alter table position add column if not exists step_distance float;
+alter table position add column if not exists time_delta float;
+alter table position add column if not exists vertical_speed float;
+alter table position add column if not exists cum_distance float;
+
+with step as (
+    select device, timestamp,
+        coalesce(position_distance(lag(location) over w, location), 0)
+            as step_distance,
+        coalesce(extract(epoch from timestamp - lag(timestamp) over w), 0)
+            as time_delta,
+        st_z(location) - st_z(lag(location) over w) as dz
+    from position
+    window w as (partition by device order by timestamp)
+),
+derived as (
+    select device, timestamp, step_distance, time_delta,
+        case when time_delta > 0 then dz / time_delta else 0 end
+            as vertical_speed,
+        sum(step_distance) over (partition by device order by timestamp)
+            as cum_distance
+    from step
+)
+update position p
+set step_distance = d.step_distance,
+    time_delta = d.time_delta,
+    vertical_speed = d.vertical_speed,
+    cum_distance = d.cum_distance
+from derived d
+where p.device = d.device and p.timestamp = d.timestamp;
+
+commit;
@@ -0,0 +1,43 @@
+-- migrate position table to position table partitioned by month; run
+-- position-derived.sql migration first
+--
+--     psql -f db/migrate/position-derived.sql antrak
+--     psql -f db/migrate/position-partitioned.sql antrak
+
+begin;
+
+alter table track drop constraint track_device_start_fkey;
+alter table track drop constraint track_device_end_fkey;
+alter table category drop constraint category_device_start_fkey;
+alter table category drop constraint category_device_end_fkey;
+
+alter table position rename to position_old;
+alter index position_pkey rename to position_old_pkey;
+
+\ir ../schema/position-partitioned.sql
+
+select position_add_partitions(min(timestamp), max(timestamp))
+from position_old;
+
+insert into position (
+    device, timestamp, heading, speed, location,
+    step_distance, time_delta, vertical_speed, cum_distance
+)
+select device, timestamp, heading, speed, location,
+    step_distance, time_delta, vertical_speed, cum_distance
+from position_old;
+
+drop table position_old;
+
+alter table track add constraint track_device_start_fkey
+    foreign key (device, start) references position(device, timestamp);
+alter table track add constraint track_device_end_fkey
+    foreign key (device, "end") references position(device, timestamp);
+alter table category add constraint category_device_start_fkey
+    foreign key (device, start) references position(device, timestamp);
+alter table category add constraint category_device_end_fkey
+    foreign key (device, "end") references position(device, timestamp);
+
+commit;
+
+analyze position;
@@ -0,0 +1,10 @@
+-- create indexes of track search
+--
+--     psql -f db/migrate/track-search.sql antrak
+
+create extension if not exists pg_trgm;
+
+create index if not exists track_search_text_idx on track
+    using gin (to_tsvector('simple', trip || ' ' || name));
+create index if not exists track_search_regex_idx on track
+    using gin ((trip || ' ' || name) gin_trgm_ops);
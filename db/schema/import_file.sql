@@ -0,0 +1,11 @@
+drop table if exists import_file;
+create table import_file (
+    device varchar(10),
+    path text,
+    inode bigint not null,
+    size bigint not null,
+    hash bytea not null, -- hash of file content before the offset
+    "offset" bigint not null, -- offset of data not imported yet
+    timestamp timestamp with time zone, -- timestamp of last position
+    primary key (device, path)
+);
@@ -0,0 +1,45 @@
+-- position table partitioned by month, requires PostgreSQL 12
+--
+-- partitions are created with position_add_partitions function on import
+-- of positions
+
+drop table if exists position cascade;
+create table position (
+    device varchar(10),
+    timestamp timestamp with time zone,
+    heading float not null, -- true, degrees
+    speed float not null,  -- km/h
+    -- values derived from previous position of the device
+    step_distance float, -- meters
+    time_delta float, -- seconds
+    vertical_speed float, -- m/s
+    cum_distance float, -- meters, since first position of the device
+    location geometry(PointZ, 4326),
+    primary key (device, timestamp)
+) partition by range (timestamp);
+
+create index position_timestamp_idx on position using brin (timestamp);
+create index position_location_idx on position using gist (location);
+
+-- create monthly partitions of position table for a time period; month
+-- boundaries are in UTC
+create or replace function position_add_partitions(
+    start timestamp with time zone,
+    "end" timestamp with time zone
+) returns void as $$
+declare
+    month timestamp := date_trunc('month', start at time zone 'UTC');
+begin
+    while month at time zone 'UTC' <= "end" loop
+        execute format(
+            'create table if not exists %I partition of position'
+            ' for values from (%L) to (%L)',
+            'position_' || to_char(month, 'YYYY_MM'),
+            month at time zone 'UTC',
+            (month + interval '1 month') at time zone 'UTC'
+        );
+        month := month + interval '1 month';
+    end loop;
+end;
+$$ language plpgsql;
+
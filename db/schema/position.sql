@@ -4,6 +4,11 @@ create table position (
     timestamp timestamp with time zone,
     heading float not null, -- true, degrees
     speed float not null,  -- km/h
+    -- values derived from previous position of the device
+    step_distance float, -- meters
+    time_delta float, -- seconds
+    vertical_speed float, -- m/s
+    cum_distance float, -- meters, since first position of the device
     primary key (device, timestamp)
 );
 
@@ -0,0 +1,10 @@
+-- distance between positions [m] with haversine formula; the formula and
+-- Earth radius are the same as in antrak.position.distance function
+create or replace function position_distance(a geometry, b geometry)
+returns float as $$
+    select 2 * 6371008.8 * asin(least(1, sqrt(
+        sin(radians(st_y(b) - st_y(a)) / 2) ^ 2
+        + cos(radians(st_y(a))) * cos(radians(st_y(b)))
+            * sin(radians(st_x(b) - st_x(a)) / 2) ^ 2
+    )))
+$$ language sql immutable strict parallel safe;
@@ -10,4 +10,9 @@ create table track (
     foreign key (device, "end") references position(device, timestamp)
 );
 
+-- indexes of track search, see antrak.dao.search module
+create index track_search_text_idx on track
+    using gin (to_tsvector('simple', trip || ' ' || name));
+create index track_search_regex_idx on track
+    using gin ((trip || ' ' || name) gin_trgm_ops);
 
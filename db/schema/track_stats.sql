@@ -0,0 +1,16 @@
+drop table if exists track_stats;
+create table track_stats (
+    trip varchar(30),
+    name varchar(30),
+    device varchar(10),
+    distance float not null, -- meters
+    duration float not null, -- seconds
+    max_speed float not null, -- km/h
+    min_lon float not null, -- bounding box of track positions
+    min_lat float not null,
+    max_lon float not null,
+    max_lat float not null,
+    count integer not null, -- number of positions
+    primary key (trip, name, device),
+    foreign key (trip, name, device) references track on delete cascade
+);